@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+import optparse
+import os
+import sys
+import json
+import time
+import copy
+import shutil
+import platform
+import subprocess
+import cProfile
+import pstats
+import numpy as np
+import pandas as pd
+import solarnc as snc
+import hawaii_nrel as nrel
+
+phases = ['format', 'extend', 'split', 'fselect', 'train', 'test']
+
+def parse_options():
+    usage_str = "%prog -c json_config_file [-w workdir] [-d days] "\
+            "[-s stations] [-r rate] [-p phases] [-j num_jobs] [-o file] "\
+            "[-b baseline_file] [-P num_functions]"
+    parser = optparse.OptionParser(usage_str)
+    parser.add_option("-c", dest="config", type="string",
+            help="path to the json file with the base configuration")
+    parser.add_option("-w", dest="workdir", type="string", default="bench",
+            help="directory for the synthetic data and the phase outputs")
+    parser.add_option("-d", dest="days", type="string", default="2,8",
+            help="comma separated list of day counts (scales) to run")
+    parser.add_option("-s", dest="nstations", type="int",
+            help="number of stations (default all the format stations)")
+    parser.add_option("-r", dest="rate", type="int", default=1,
+            help="sampling period of the synthetic data in seconds")
+    parser.add_option("-p", dest="phases", type="string",
+            default=",".join(phases),
+            help="comma separated list of phases to time")
+    parser.add_option("-j", dest="npjobs", type="int", default=1,
+            help="number of parallel jobs of the phases")
+    parser.add_option("-o", dest="outfile", type="string",
+            help="json results file (default workdir/results.json)")
+    parser.add_option("-b", dest="baseline", type="string",
+            help="results file of a previous run to compare with")
+    parser.add_option("-P", dest="profile", type="int", default=0,
+            help="record the given number of functions with the largest "
+            "cumulative time of each phase (cProfile of the main process)")
+    parser.add_option("-x", dest="phase", type="string",
+            help=optparse.SUPPRESS_HELP)
+    parser.add_option("-f", dest="proffile", type="string",
+            help=optparse.SUPPRESS_HELP)
+
+    options, args  = parser.parse_args()
+    if not options.config: parser.error("missing json config file")
+    return (options, args)
+
+# Synthetic days in the raw format of the NREL files read by
+# hawaii_nrel.format_data: Seconds, Year, DOY, HST (hhmm) and the GHI
+# columns, without header. The irradiance is a bell shaped clear sky curve
+# attenuated by clouds that move over the stations, so that the stations see
+# the same clouds with a delay that depends on their position.
+def generate_day(fname, year, doy, stations, rate, seed, start=730, end=1730):
+    rng = np.random.default_rng(seed)
+    t0 = (start // 100) * 3600 + (start % 100) * 60
+    t1 = (end // 100) * 3600 + (end % 100) * 60
+    t = np.arange(t0, t1, rate)
+    n = len(t)
+
+    # clear sky from 6:00 to 19:00
+    x = np.clip((t - 6 * 3600) / (13 * 3600), 0, 1)
+    clear = 1000 * np.sin(np.pi * x) ** 1.2
+
+    # clouds: smoothed noise, delayed for each station
+    maxdelay = 600 // rate + 1
+    noise = rng.standard_normal(n + maxdelay)
+    window = max(1, 300 // rate)
+    clouds = np.convolve(noise, np.ones(window) / window, mode='same')
+    clouds = 1 / (1 + np.exp(-4 * clouds))
+
+    lon0 = min(sta['longitude'] for sta in stations.values()) \
+            if stations else 0
+    data = {}
+    for c in nrel.data_columns[len(nrel.time_columns):]:
+        name = c.split()[-1]
+        if name in stations:
+            delay = int((stations[name]['longitude'] - lon0) * 1e5 / rate)
+        else:
+            delay = 0
+        delay = min(delay, maxdelay - 1)
+        k = 1 - 0.7 * clouds[delay:delay + n]
+        ghi = clear * k + rng.normal(0, 2, n)
+        # a few small negative values, as in the real files
+        ghi[ghi < 0] = -0.5
+        data[c] = ghi
+
+    hst = (t // 3600) * 100 + (t % 3600) // 60
+    df = pd.DataFrame(data)
+    df.insert(0, 'HST', hst)
+    df.insert(0, 'DOY', doy)
+    df.insert(0, 'Year', year)
+    df.insert(0, 'Seconds', t % 60)
+    df.to_csv(fname, header=False, index=False, float_format='%.2f')
+    return n
+
+def generate_dataset(path, ndays, stations, rate, year=2010, doy=100):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    nrows = 0
+    for d in range(doy, doy + ndays):
+        fname = "{}/{}{:03d}.txt".format(path, year, d)
+        nrows += generate_day(fname, year, d, stations, rate, d)
+    return nrows
+
+# configuration of one scale: the base configuration with all the paths in
+# the scale directory and the selected stations
+def get_scale_config(config, path, nstations):
+    config = copy.deepcopy(config)
+    fconfig = config['format']
+    if nstations is not None:
+        fconfig['stations'] = fconfig['stations'][:nstations]
+    names = fconfig['stations']
+    dtset = config['dataset']
+    dtset['stations'] = [s for s in dtset['stations'] if s['name'] in names]
+    dtset['path'] = "{}/infiles".format(path)
+    fconfig['outpath'] = "{}/format".format(path)
+    fconfig['rejectpath'] = "{}/format/reject".format(path)
+    if 'extend' in config and 'outpath' in config['extend']:
+        config['extend']['outpath'] = "{}/extend".format(path)
+    config['split']['outpath'] = "{}/split".format(path)
+    fsconfig = config['fselect']
+    fsconfig['outpath'] = "{}/fselect".format(path)
+    target = fsconfig['forecasting target']
+    target['stations'] = [s for s in target['stations'] if s in names]
+    if len(target['stations']) == 0:
+        target['stations'] = names[:1]
+    tconfig = config['train']
+    tconfig['outpath'] = "{}/train".format(path)
+    if 'memmap' in tconfig:
+        tconfig['memmap']['path'] = "{}/memmap".format(path)
+    return config
+
+# number of files and rows processed by a phase
+def get_phase_inputs(phase, config):
+    ext = snc.get_storage(config['dataset'])
+    if phase == 'format':
+        path = config['dataset']['path']
+        files = [os.path.join(path, f) for f in os.listdir(path)]
+    elif phase in ['extend', 'split', 'fselect']:
+        path = config['format']['outpath']
+        files = [os.path.join(path, f) for f in os.listdir(path) \
+                if f.endswith("." + ext)]
+    else:
+        sname = 'trainset' if phase == 'train' else 'testset'
+        days = snc.read_list("{}/{}.csv".format(config['split']['outpath'], \
+                sname))
+        files = ["{}/{}_features.{}".format(config['fselect']['outpath'], \
+                d, ext) for d in days]
+    if phase == 'format':
+        rows = sum(snc.count_rows(f) + 1 for f in files)
+    else:
+        rows = sum(snc.count_rows(f) for f in files)
+    return len(files), rows
+
+# Each phase runs in its own process (this script with -x), that imports the
+# tool as a module and calls its main function, optionally under cProfile.
+# The resource usage returned by wait4 covers the phase and the processes it
+# waited for, so the peak RSS is the largest of the whole phase.
+def run_phase(phase, cfile, npjobs, logfile, proffile=None):
+    cmd = [sys.executable, os.path.abspath(__file__), "-c", cfile, \
+            "-x", phase, "-j", str(npjobs)]
+    if proffile is not None:
+        cmd += ["-f", proffile]
+    with open(logfile, 'w') as log:
+        t0 = time.time()
+        p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, ru = os.wait4(p.pid, 0)
+        wall = time.time() - t0
+        p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != 0:
+        print("Error: phase {} failed, see {}".format(phase, logfile))
+        raise RuntimeError
+    return {'wall': wall, 'cpu': ru.ru_utime + ru.ru_stime, \
+            'maxrss_kb': ru.ru_maxrss}
+
+def exec_phase(phase, cfile, npjobs, proffile=None):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    module = __import__(phase)
+    sys.argv = ["{}.py".format(phase), "-c", cfile]
+    if phase != 'split':
+        sys.argv += ["-j", str(npjobs)]
+    options, args = module.parse_options()
+    if proffile is None:
+        module.main(options, args)
+    else:
+        cProfile.runctx("module.main(options, args)", globals(), \
+                {'module': module, 'options': options, 'args': args}, \
+                proffile)
+
+def run_scale(config, workdir, ndays, options, selected):
+    path = os.path.abspath("{}/days{}".format(workdir, ndays))
+    # outputs of previous runs would be reused by the phase caches
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    config = get_scale_config(config, path, options.nstations)
+    cfile = "{}/config.json".format(path)
+    names = config['format']['stations']
+    stations = dict((s['name'], s) for s in config['dataset']['stations'])
+    print("Scale {} days, {} stations, {} s sampling".format(ndays, \
+            len(names), options.rate))
+
+    t0 = time.time()
+    nrows = generate_dataset(config['dataset']['path'], ndays, stations, \
+            options.rate)
+    print("Generated {} rows in {:.2f} s".format(nrows, time.time() - t0))
+    with open(cfile, 'w') as f:
+        json.dump(config, f, indent=1)
+
+    results = []
+    for phase in phases:
+        if phase not in selected:
+            continue
+        if phase == 'extend' and 'extend' not in config:
+            continue
+        nfiles, rows = get_phase_inputs(phase, config)
+        logfile = "{}/{}.log".format(path, phase)
+        proffile = "{}/{}.prof".format(path, phase) \
+                if options.profile > 0 else None
+        res = run_phase(phase, cfile, options.npjobs, logfile, proffile)
+        res.update({'days': ndays, 'stations': len(names), \
+                'rate': options.rate, 'npjobs': options.npjobs, \
+                'phase': phase, 'files': nfiles, 'rows': rows, \
+                'files_per_s': nfiles / res['wall'], \
+                'rows_per_s': rows / res['wall']})
+        if proffile is not None:
+            res['profile'] = snc.get_top_functions(pstats.Stats(proffile), \
+                    options.profile)
+        print("{:>8} {:8.2f} s {:10.0f} rows/s {:8.2f} files/s {:8d} kB"\
+                .format(phase, res['wall'], res['rows_per_s'], \
+                res['files_per_s'], res['maxrss_kb']))
+        results.append(res)
+    return results
+
+def compare(results, baseline):
+    base = dict(((r['days'], r['phase']), r) for r in baseline['results'])
+    print("Comparison with the baseline (wall time and peak RSS ratios):")
+    for r in results:
+        b = base.get((r['days'], r['phase']))
+        if b is None:
+            continue
+        print("{:>6} days {:>8} {:6.2f} {:6.2f}".format(r['days'], \
+                r['phase'], r['wall'] / b['wall'], \
+                r['maxrss_kb'] / b['maxrss_kb']))
+
+def main(options, args):
+    if options.phase is not None:
+        exec_phase(options.phase, options.config, options.npjobs, \
+                options.proffile)
+        return
+
+    config = snc.load_config(options.config)
+    print("Correct config format")
+    selected = options.phases.split(',')
+    for p in selected:
+        if p not in phases:
+            print("Error: unknown phase {}".format(p))
+            raise ValueError
+    if not os.path.exists(options.workdir):
+        os.makedirs(options.workdir)
+
+    srcpath = os.path.dirname(os.path.abspath(__file__))
+    sources = ["{}/{}.py".format(srcpath, p) for p in \
+            phases + ['solarnc', 'hawaii_nrel']]
+    report = {'meta': {'date': time.strftime("%Y-%m-%dT%H:%M:%S"), \
+            'host': platform.node(), 'cpus': os.cpu_count(), \
+            'python': platform.python_version(), \
+            'pandas': pd.__version__, 'numpy': np.__version__, \
+            'code': snc.get_code_version(sources), \
+            'config': options.config}, 'results': []}
+    for d in [int(d) for d in options.days.split(',')]:
+        report['results'] += run_scale(config, options.workdir, d, options, \
+                selected)
+
+    outfile = options.outfile if options.outfile else \
+            "{}/results.json".format(options.workdir)
+    with open(outfile, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Results written to {}".format(outfile))
+
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            compare(report['results'], json.load(f))
+
+if __name__ == "__main__":
+    main(*parse_options())
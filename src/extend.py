@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import pandas as pd
+import json
 import optparse
 import os
 import glob
@@ -15,30 +16,87 @@ def parse_options():
             help="path to the json file with the configuration parameters")
     parser.add_option("-j", dest="npjobs", type="int",
             help="number of parallel jobs to use", default = mp.cpu_count())
+    parser.add_option("-b", dest="backend", type="choice",
+            choices=["pool", "futures"], default="pool",
+            help="parallel backend: pool (multiprocessing) or futures")
 
     options, args  = parser.parse_args()
     if not options.config: parser.error("missing json config file")
     return (options, args)
 
-def add_new_variables(infile, stations, timezone, functions):
-    df = snc.read_csv(infile, timezone)
-    for f in functions:
-        try:
-            module = __import__(f['module'])
-            fun = getattr(module, f['fname'])
-            if not callable(fun):
-                print("fname should be a callable python object")
-                raise ValueError
-        except AttributeError:
-            print("Error: could not find function {} in module {}"\
-                    .format(f['fname'],f['module']))
+def apply_function(df, f, stations):
+    try:
+        module = __import__(f['module'])
+        fun = getattr(module, f['fname'])
+        if not callable(fun):
+            print("fname should be a callable python object")
+            raise ValueError
+    except AttributeError:
+        print("Error: could not find function {} in module {}"\
+                .format(f['fname'],f['module']))
+    else:
+        if 'args' in f:
+            args = tuple(f['args'])
+            df = fun(df, f['skip existing'], stations, *args)
         else:
-            if 'args' in f:
-                args = tuple(f['args'])
-                df = fun(df, f['skip existing'], stations, *args)
-            else:
-                df = fun(df, f['skip existing'], stations)
-    snc.save_csv(df, infile)
+            df = fun(df, f['skip existing'], stations)
+    return df
+
+# each function key depends on the key of the previous function, so that a
+# change in a function invalidates the sidecars of the following ones
+def get_function_keys(infile, stations, timezone, functions):
+    keys = []
+    key = snc.get_hash([snc.get_files_signature([infile]), stations, timezone])
+    for f in functions:
+        code = snc.get_code_version([__import__(f['module']).__file__])
+        key = snc.get_hash([key, f, code])
+        keys.append(key)
+    return keys
+
+def add_new_variables(infile, stations, timezone, functions, extpath=None):
+    if extpath is None:
+        df = snc.read_data(infile, timezone)
+        newdf = df.copy()
+        for f in functions:
+            newdf = apply_function(newdf, f, stations)
+        if not newdf.equals(df):
+            snc.save_data(newdf, infile)
+        return
+
+    base = os.path.basename(infile)
+    day, ext = os.path.splitext(base)
+    daypath = "{}/{}".format(extpath, day)
+    if not os.path.exists(daypath):
+        os.makedirs(daypath, exist_ok=True)
+    keys = get_function_keys(infile, stations, timezone, functions)
+    sidecars = ["{}/{}-{}{}".format(daypath, f['fname'], k[:16], ext) \
+            for f, k in zip(functions, keys)]
+
+    missing = [i for i, sc in enumerate(sidecars) if not os.path.exists(sc)]
+    if len(missing) > 0:
+        first = missing[0]
+        df = snc.read_data(infile, timezone)
+        for sc in sidecars[:first]:
+            df = snc.apply_changes(df, snc.read_data(sc, timezone))
+        for f, sc in zip(functions[first:], sidecars[first:]):
+            newdf = apply_function(df.copy(), f, stations)
+            snc.save_data(snc.get_changes(df, newdf), sc)
+            df = newdf
+
+    for fname in os.listdir(daypath):
+        fname = "{}/{}".format(daypath, fname)
+        if fname not in sidecars:
+            os.remove(fname)
+
+    manifest = snc.get_manifest_fname(extpath, infile)
+    if os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            if json.load(f) == sidecars:
+                return
+    tmpfile = "{}.{}.tmp".format(manifest, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(sidecars, f)
+    os.replace(tmpfile, manifest)
 
 def print_stations(stations):
     print("Considering the following stations: ")
@@ -56,6 +114,7 @@ def print_functions(functions):
 
 def main(options, args):
     config = snc.load_config(options.config)
+    snc.jobs_backend = options.backend
     if 'extend' not in config:
         print("Error: no extend property in {}".format(options.config))
         os._exit(-1)
@@ -74,14 +133,39 @@ def main(options, args):
 
     path = fconfig['outpath']
     print("Extending files from: {}".format(path))
-    infiles  = glob.glob("{}/*.csv".format(path))
+    extpath = snc.get_extend_path(config)
+    if extpath is None:
+        print("Files are extended in place")
+        cachepath = path
+    else:
+        print("New columns go to: {}".format(extpath))
+        if not os.path.exists(extpath):
+            os.makedirs(extpath)
+        cachepath = extpath
+    snc.start_report(cachepath, 'extend')
+    ext = snc.get_storage(dtset)
+    infiles  = glob.glob("{}/*.{}".format(path, ext))
     print(infiles)
 
     functions = extend['functions']
     print_functions(functions)
 
-    args = [(f, stations, timezone, functions) for f in infiles]
-    snc.runjobs(add_new_variables, args, options.npjobs)
+    args = [(f,) for f in infiles]
+    shared = (stations, timezone, functions, extpath)
+
+    modules = [__import__(f['module']).__file__ for f in functions]
+    code = snc.get_code_version([__file__, snc.__file__] + modules)
+    key = snc.get_hash([stations, timezone, functions, extpath, code])
+    jobs = []
+    for f in infiles:
+        if extpath is None:
+            outputs = [f]
+        else:
+            outputs = [snc.get_manifest_fname(extpath, f)]
+        jobs.append((os.path.basename(f), key, [f], outputs))
+    cfile = snc.get_cache_fname(cachepath, 'extend')
+    snc.runjobs_cached(add_new_variables, args, jobs, cfile, options.npjobs,\
+            shared)
 
 if __name__ == "__main__":
     main(*parse_options())
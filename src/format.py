@@ -12,6 +12,9 @@ def parse_options():
             help="path to the json file with the configuration parameters")
     parser.add_option("-j", dest="npjobs", type="int",
             help="number of parallel jobs to use", default = mp.cpu_count())
+    parser.add_option("-b", dest="backend", type="choice",
+            choices=["pool", "futures"], default="pool",
+            help="parallel backend: pool (multiprocessing) or futures")
 
     options, args  = parser.parse_args()
     if not options.config:
@@ -20,6 +23,7 @@ def parse_options():
 
 def main(options, args):
     config = snc.load_config(options.config)
+    snc.jobs_backend = options.backend
     print("Correct config format")
 
     dtset = config['dataset']
@@ -33,6 +37,7 @@ def main(options, args):
     outpath = fconfig['outpath']
     if not os.path.exists(outpath):
         os.makedirs(outpath)
+    snc.start_report(outpath, 'format')
 
     stations = fconfig['stations']
     print("Selected stations:")
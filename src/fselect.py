@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import pandas as pd
+import numpy as np
 import optparse
 import os
 import glob
@@ -15,6 +16,9 @@ def parse_options():
             help="path to the json file with the configuration parameters")
     parser.add_option("-j", dest="npjobs", type="int",
             help="number of parallel jobs to use", default = mp.cpu_count())
+    parser.add_option("-b", dest="backend", type="choice",
+            choices=["pool", "futures"], default="pool",
+            help="parallel backend: pool (multiprocessing) or futures")
 
     options, args  = parser.parse_args()
     if not options.config: parser.error("missing json config file")
@@ -40,6 +44,25 @@ def get_interval_string(horizon, interval):
         istr = '[t+{},t+{}+{}]'.format(horizon,horizon,interval)
     return istr
 
+# horizon and interval may be lists, to build the targets of several horizons
+# from the same resampled data. A single interval applies to every horizon,
+# and a list of intervals needs one interval for each horizon (the targets are
+# named after the horizon, so a single horizon can not take several).
+def get_horizons(fsconfig):
+    target = fsconfig['forecasting target']
+    horizons = target['horizon']
+    intervals = target['interval']
+    if isinstance(horizons, str):
+        horizons = [horizons]
+    if isinstance(intervals, str):
+        intervals = [intervals] * len(horizons)
+    if len(horizons) != len(intervals):
+        print("Error: there should be an interval for each horizon, got {} "\
+                "horizons and {} intervals".format(len(horizons), \
+                len(intervals)))
+        raise ValueError
+    return list(zip(horizons, intervals))
+
 def check_config(config):
     outpath = config['outpath']
     period = config['period']
@@ -67,15 +90,18 @@ def check_config(config):
             format(features['unlagged']))
 
     fvar = config['forecasting target']['variable']
-    horizon = config['forecasting target']['horizon']
-    interval = config['forecasting target']['interval']
     fsta = config['forecasting target']['stations']
+    horizons = [h for h, i in get_horizons(config)]
+    if len(set(horizons)) < len(horizons):
+        print("Error: repeated forecasting horizons")
+        raise ValueError
 
     fvarlist = ["{} {}".format(sta, fvar) for sta in fsta]
     print("Forecasting variables: {}".format(fvarlist))
-    print("Forecasting horizon: t+{}".format(horizon))
-    istr = get_interval_string(horizon, interval)
-    print("Forecasting interval {}".format(istr))
+    for horizon, interval in get_horizons(config):
+        print("Forecasting horizon: t+{}".format(horizon))
+        istr = get_interval_string(horizon, interval)
+        print("Forecasting interval {}".format(istr))
 
 
 def get_lagged_vars(stations, fsconfig):
@@ -96,31 +122,57 @@ def get_unlagged_vars(stations, fsconfig):
     columns.extend(features["unlagged"])
     return columns
 
+def get_lagged_names(columns, lags):
+    return ["{} lag{}".format(c,l) for c in columns for l in range(lags)]
+
+def get_lagged_matrix(values, lags):
+    # row i holds values[i], values[i-1], ..., values[i-lags+1] for every
+    # column, built from a strided view and copied once into a single block
+    n, ncols = values.shape
+    if n < lags:
+        return np.empty((0, ncols * lags))
+    win = np.lib.stride_tricks.sliding_window_view(values, lags, axis=0)
+    return np.ascontiguousarray(win[:, :, ::-1]).reshape(-1, ncols * lags)
+
 def get_lagged_data(df, columns, lags):
-    newd = {}
-    for c in columns:
-        newnames = ["{} lag{}".format(c,l) for l in range(lags)]
-        newcols = [df[c].shift(s) for s in range(lags)]
-        newd.update(list(zip(newnames, newcols)))
-    return newd
+    names = get_lagged_names(columns, lags)
+    if not columns:
+        return pd.DataFrame(index=df.index)
+    values = df[columns].to_numpy(dtype=float)
+    lmat = get_lagged_matrix(values, lags)
+    return pd.DataFrame(lmat, index=df.index[lags - 1:], columns=names)
+
+def get_interval_offsets(horizon, interval):
+    off1 = pd.Timedelta(horizon)
+    off2 = off1
+    if interval[0] == '-':
+         off1 += pd.Timedelta(interval)
+    else:
+         off2 += pd.Timedelta(interval)
+    return off1, off2
+
+def get_interval_means(tdata, off1, off2):
+    # mean of tdata.loc[s + off1:s + off2] for every s in the index, computed
+    # with cumulative sums. NaNs are skipped and empty intervals give NaN.
+    idx = tdata.index
+    start = idx.searchsorted(idx + off1, side='left')
+    end = idx.searchsorted(idx + off2, side='right')
+    values = tdata.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    csum = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    ccnt = np.concatenate(([0], np.cumsum(valid)))
+    cnt = ccnt[end] - ccnt[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        th = np.where(cnt > 0, (csum[end] - csum[start]) / cnt, np.nan)
+    return pd.Series(th, index=idx)
 
 def get_target_data(df, tstations, fvar, horizon, interval):
-    def get_values(tdata, horizon, interval):
-        off1 = pd.Timedelta(horizon)
-        off2 = off1
-        if interval[0] == '-':
-             off1 += pd.Timedelta(interval)
-        else:
-             off2 += pd.Timedelta(interval)
-        th = tdata.index.map(lambda s: tdata.loc[s + off1:s + off2].mean())
-        return pd.Series(th, index=tdata.index)
-
+    off1, off2 = get_interval_offsets(horizon, interval)
     newd = {}
     for sta in tstations:
         fdata = df['{} {}'.format(fvar,sta)]
         tname = "{} {} {}".format(fvar,sta,horizon)
-        tdata = get_values(fdata, horizon, interval)
-        newd[tname] = tdata
+        newd[tname] = get_interval_means(fdata, off1, off2)
     return newd
 
 def get_offset(df, period):
@@ -129,49 +181,188 @@ def get_offset(df, period):
         T = '1' + T
     return (pd.Timedelta(period) - pd.Timedelta(T))
 
-def fselect(infile, stations, timezone, fsconfig):
-    outpath = fsconfig['outpath']
-    base = os.path.basename(infile)
-    day = os.path.splitext(base)[0]
-
+def get_lags(fsconfig):
+    return int(timeparse(fsconfig['window']) / timeparse(fsconfig['period']))
+
+# Continuous mode: consecutive day files are treated as a single series. The
+# day is extended with the end of the previous day and the beginning of the
+# next one (only the samples needed by the lags and the targets), so that the
+# first lags and the last targets of the day can be computed. The outputs
+# only keep the rows of the day itself.
+def get_neighbours(infiles, timezone):
+    starts = [snc.read_data(f, timezone, []).index[0] for f in infiles]
+    order = [f for s, f in sorted(zip(starts, infiles))]
+    neighbours = {}
+    for i, f in enumerate(order):
+        prev = order[i - 1] if i > 0 else None
+        nxt = order[i + 1] if i < len(order) - 1 else None
+        neighbours[f] = (prev, nxt)
+    return neighbours
+
+def get_margins(fsconfig):
+    period = pd.Timedelta(fsconfig['period'])
+    offsets = [get_interval_offsets(h, i) for h, i in get_horizons(fsconfig)]
+    before = (get_lags(fsconfig) + 1) * period
+    after = max(max(off1, off2) for off1, off2 in offsets)
+    after = max(after, pd.Timedelta(0)) + period
+    return before, after
+
+# labels of the resampled rows that hold samples of the day. A row labelled
+# after the first sample of the next day belongs to the next day.
+def get_day_span(index, period, offset, nxt_start=None):
+    bounds = pd.Series(0, index=index[[0, -1]])
+    labels = bounds.resample(period, loffset=offset).mean().index
+    last = labels[-1]
+    if nxt_start is not None and last >= nxt_start:
+        last = nxt_start - pd.Timedelta(1, 'ns')
+    return slice(labels[0], last)
+
+def read_day_span(infile, timezone, period, extpath=None, neighbours=None):
+    df = snc.read_day(infile, timezone, extpath, [])
+    nxt_start = None
+    if neighbours is not None and neighbours[infile][1] is not None:
+        nxt = snc.read_day(neighbours[infile][1], timezone, extpath, [])
+        nxt_start = nxt.index[0]
+    return get_day_span(df.index, period, get_offset(df, period), nxt_start)
+
+# resample data, start clustering from the first sample to the right
+# label with the last sample of the cluster
+def read_resampled(infile, timezone, fsconfig, columns, extpath=None, \
+        neighbours=None):
     period = fsconfig['period']
-    window = fsconfig['window']
-    lags = int(timeparse(window) / timeparse(period))
+    df = snc.read_day(infile, timezone, extpath, columns)
+    offset = get_offset(df, period)
+    span = get_day_span(df.index, period, offset)
+    if neighbours is not None:
+        before, after = get_margins(fsconfig)
+        start, end = df.index[0], df.index[-1]
+        prev, nxt = neighbours[infile]
+        l = []
+        if prev is not None:
+            pdf = snc.read_day(prev, timezone, extpath, columns)
+            l.append(pdf[(pdf.index >= start - before) & (pdf.index < start)])
+        l.append(df)
+        if nxt is not None:
+            ndf = snc.read_day(nxt, timezone, extpath, columns)
+            l.append(ndf[(ndf.index > end) & (ndf.index <= end + after)])
+            span = get_day_span(df.index, period, offset, ndf.index[0])
+        df = pd.concat(l)
+    return df.resample(period, loffset=offset).mean(), span
+
+# fdf holds the lagged features and df the resampled variables, for the same
+# index. Rows with missing lags or targets are dropped, so with several
+# horizons the rows kept are those that have the targets of all of them.
+def get_feature_target_frames(df, fdf, fsconfig, unlagged):
     fvar = fsconfig['forecasting target']['variable']
-    horizon = fsconfig['forecasting target']['horizon']
-    interval = fsconfig['forecasting target']['interval']
     tstations = fsconfig['forecasting target']['stations']
 
-
-    # build features matrix
-    lagged = get_lagged_vars(stations, fsconfig)
-    unlagged = get_unlagged_vars(stations, fsconfig)
-    targets = ["{} {}".format(fvar,sta) for sta in tstations]
-    columns = list(set().union(lagged, unlagged, targets))
-
-    # resample data, start clustering from the first sample to the right
-    # label with the last sample of the cluster
-    df = snc.read_csv(infile, timezone)[columns]
-    offset = get_offset(df, period)
-    df = df.resample(period, loffset=offset).mean()
-
     # build feature matrix (1 row is a feature vector)
-    ldata = get_lagged_data(df, lagged, lags)
-    fdf = pd.DataFrame(ldata, index=df.index).dropna()
+    fdf = fdf.dropna()
     df = df.reindex(fdf.index)
     fdf = pd.concat([fdf, df[unlagged]], axis=1)
 
     # build target matrix
-    tdata = get_target_data(df, tstations, fvar, horizon, interval)
+    tdata = {}
+    for horizon, interval in get_horizons(fsconfig):
+        tdata.update(get_target_data(df, tstations, fvar, horizon, interval))
     tdf = pd.DataFrame(tdata, index=df.index).dropna()
-    fdf.reindex(tdf.index)
+    fdf = fdf.reindex(tdf.index)
+    return fdf, tdf
 
-    # save files
-    snc.save_csv(fdf, "{}/{}_features.csv".format(outpath, day))
-    snc.save_csv(tdf, "{}/{}_targets.csv".format(outpath, day))
+def save_feature_target_frames(fdf, tdf, infile, fsconfig):
+    outpath = fsconfig['outpath']
+    day, ext = os.path.splitext(os.path.basename(infile))
+    snc.save_data(fdf, "{}/{}_features{}".format(outpath, day, ext))
+    snc.save_data(tdf, "{}/{}_targets{}".format(outpath, day, ext))
+
+def get_columns(stations, fsconfig):
+    fvar = fsconfig['forecasting target']['variable']
+    tstations = fsconfig['forecasting target']['stations']
+    lagged = get_lagged_vars(stations, fsconfig)
+    unlagged = get_unlagged_vars(stations, fsconfig)
+    targets = ["{} {}".format(fvar,sta) for sta in tstations]
+    return lagged, unlagged, list(set().union(lagged, unlagged, targets))
+
+def fselect(infile, stations, timezone, fsconfig, extpath=None, \
+        neighbours=None):
+    lagged, unlagged, columns = get_columns(stations, fsconfig)
+    df, span = read_resampled(infile, timezone, fsconfig, columns, extpath, \
+            neighbours)
+    fdf = get_lagged_data(df, lagged, get_lags(fsconfig))
+    fdf, tdf = get_feature_target_frames(df, fdf, fsconfig, unlagged)
+    save_feature_target_frames(fdf.loc[span], tdf.loc[span], infile, fsconfig)
+
+# same as fselect for a day that is already in memory (used by the pipeline
+# tool), infile only gives the name of the outputs
+def fselect_frame(df, infile, stations, fsconfig):
+    lagged, unlagged, columns = get_columns(stations, fsconfig)
+    period = fsconfig['period']
+    offset = get_offset(df, period)
+    span = get_day_span(df.index, period, offset)
+    df = df[columns].resample(period, loffset=offset).mean()
+    fdf = get_lagged_data(df, lagged, get_lags(fsconfig))
+    fdf, tdf = get_feature_target_frames(df, fdf, fsconfig, unlagged)
+    save_feature_target_frames(fdf.loc[span], tdf.loc[span], infile, fsconfig)
+
+# Partitioned mode: the columns are split in groups, one for each station
+# (its station variables and target) and one for the single variables. Each
+# (day, group) job resamples and lags only the columns of its group and saves
+# them to a part file, and a merge job per day joins the parts and builds the
+# feature and target files, exactly as fselect does.
+def get_column_groups(stations, fsconfig):
+    features = fsconfig['features']
+    fvar = fsconfig['forecasting target']['variable']
+    tstations = fsconfig['forecasting target']['stations']
+    names = [sta['name'] for sta in stations]
+
+    groups = []
+    for name in names:
+        lagged = ["{} {}".format(v,name) for v in features['station lagged']]
+        unlagged = ["{} {}".format(v,name) \
+                for v in features['station unlagged']]
+        targets = ["{} {}".format(fvar,name)] if name in tstations else []
+        groups.append((lagged, unlagged, targets))
+    targets = ["{} {}".format(fvar,sta) for sta in tstations \
+            if sta not in names]
+    groups.append((features['lagged'], features['unlagged'], targets))
+    return [g for g in groups if any(len(c) > 0 for c in g)]
+
+def get_part_fname(infile, group, fsconfig):
+    day, ext = os.path.splitext(os.path.basename(infile))
+    return "{}/.parts/{}-{}{}".format(fsconfig['outpath'], day, group, ext)
+
+def fselect_part(infile, group, stations, timezone, fsconfig, extpath=None, \
+        neighbours=None):
+    lagged, unlagged, targets = get_column_groups(stations, fsconfig)[group]
+    columns = list(set().union(lagged, unlagged, targets))
+    df, span = read_resampled(infile, timezone, fsconfig, columns, extpath, \
+            neighbours)
+    fdf = get_lagged_data(df, lagged, get_lags(fsconfig))
+    raw = [c for c in columns if c not in lagged] + \
+            [c for c in lagged if c in unlagged or c in targets]
+    part = pd.concat([fdf, df[raw]], axis=1)
+    snc.save_data(part, get_part_fname(infile, group, fsconfig))
+
+def fselect_merge(infile, stations, timezone, fsconfig, extpath=None, \
+        neighbours=None):
+    ngroups = len(get_column_groups(stations, fsconfig))
+    pfiles = [get_part_fname(infile, g, fsconfig) for g in range(ngroups)]
+    df = pd.concat([snc.read_data(f, timezone) for f in pfiles], axis=1)
+    df = df.loc[:, ~df.columns.duplicated()]
+
+    lagged = get_lagged_vars(stations, fsconfig)
+    unlagged = get_unlagged_vars(stations, fsconfig)
+    fdf = df[get_lagged_names(lagged, get_lags(fsconfig))]
+    fdf, tdf = get_feature_target_frames(df, fdf, fsconfig, unlagged)
+    span = read_day_span(infile, timezone, fsconfig['period'], extpath, \
+            neighbours)
+    save_feature_target_frames(fdf.loc[span], tdf.loc[span], infile, fsconfig)
+    for f in pfiles:
+        os.remove(f)
 
 def main(options, margs):
     config = snc.load_config(options.config)
+    snc.jobs_backend = options.backend
     print("Correct config format")
 
     dtset = config['dataset']
@@ -184,15 +375,56 @@ def main(options, margs):
             if sta['name'] in fconfig['stations']]
     print_stations(stations)
 
-    infiles  = glob.glob("{}/*.csv".format(fconfig['outpath']))
+    ext = snc.get_storage(dtset)
+    infiles  = glob.glob("{}/*.{}".format(fconfig['outpath'], ext))
     print("Input files:")
     print(infiles)
 
     fsconfig = config['fselect']
     check_config(fsconfig)
-
-    args = [(f, stations, timezone, fsconfig) for f in infiles]
-    snc.runjobs(fselect, args, options.npjobs)
+    snc.start_report(fsconfig['outpath'], 'fselect')
+
+    args = [(f,) for f in infiles]
+    extpath = snc.get_extend_path(config)
+    neighbours = None
+    if 'continuous' in fsconfig and fsconfig['continuous']:
+        print("Days are extended with the samples of the neighbouring days")
+        neighbours = get_neighbours(infiles, timezone)
+    shared = (stations, timezone, fsconfig, extpath, neighbours)
+
+    code = snc.get_code_version([__file__, snc.__file__])
+    key = snc.get_hash([stations, timezone, fsconfig, code])
+    outpath = fsconfig['outpath']
+    jobs = []
+    for f in infiles:
+        day = os.path.splitext(os.path.basename(f))[0]
+        outputs = ["{}/{}_{}.{}".format(outpath, day, t, ext) \
+                for t in ['features', 'targets']]
+        inputs = [f]
+        if neighbours is not None:
+            inputs += [n for n in neighbours[f] if n is not None]
+        if extpath is not None:
+            inputs += [snc.get_manifest_fname(extpath, i) for i in inputs]
+        jobs.append((day, key, inputs, outputs))
+    cfile = snc.get_cache_fname(outpath, 'fselect')
+    partition = fsconfig['partition'] if 'partition' in fsconfig else 'days'
+    if partition == 'days':
+        snc.runjobs_cached(fselect, args, jobs, cfile, options.npjobs, shared)
+        return
+
+    # the parts of the days that are not up to date are computed first
+    cache = snc.load_cache(cfile)
+    todo = [f for f, (name, k, inputs, outputs) in zip(infiles, jobs) \
+            if not snc.is_cached(cache, name, k, inputs)]
+    ngroups = len(get_column_groups(stations, fsconfig))
+    print("Partitioned in {} column groups".format(ngroups))
+    partpath = "{}/.parts".format(outpath)
+    if not os.path.exists(partpath):
+        os.makedirs(partpath)
+    pargs = [(f, g) for f in todo for g in range(ngroups)]
+    snc.runjobs(fselect_part, pargs, options.npjobs, shared)
+    snc.runjobs_cached(fselect_merge, args, jobs, cfile, options.npjobs, \
+            shared)
 
 if __name__ == "__main__":
     main(*parse_options())
@@ -5,6 +5,7 @@ import os
 import multiprocessing as mp
 import solarnc as snc
 import glob
+import time
 import pandas as pd
 
 # original columns in the file
@@ -29,31 +30,59 @@ data_columns = ["Seconds", "Year", "DOY", "HST",
         "GHI DH7",
         "GHI DH8"]
 
-def format_data(infile,outpath, ghi_columns, rejectpath):
-    base = os.path.basename(infile)
-    day = os.path.splitext(base)[0]
-    df = pd.read_csv(infile, header=None, names=data_columns)
+time_columns = ["Seconds", "Year", "DOY", "HST"]
+
+# build the timestamps from the integer Year, DOY, HST (hhmm) and Seconds
+# columns with datetime64 arithmetic
+def get_datetime(df):
+    year = (df.Year.to_numpy() - 1970).astype('datetime64[Y]')
+    days = year.astype('datetime64[D]') + (df.DOY.to_numpy() - 1)
+    hst = df.HST.to_numpy()
+    seconds = (hst // 100) * 3600 + (hst % 100) * 60 + df.Seconds.to_numpy()
+    dt = days.astype('datetime64[ns]') + seconds.astype('timedelta64[s]')
+    return pd.DatetimeIndex(dt).tz_localize('HST')
 
-    dt = pd.to_datetime(df.Seconds.apply(str) + ' ' + df.Year.apply(str) + ' '\
-            + df.DOY.apply(str) + ' ' + df.HST.apply(str), \
-            format='%S %Y %j %H%M')
-    dt = dt.dt.tz_localize('HST')
-    df = pd.DataFrame(dict([('datetime', dt)] + \
-            [(g, df[g]) for g in ghi_columns]))
-    df.set_index('datetime', inplace=True)
+# reads and formats a raw day file, returns the data frame and whether it
+# has to be rejected
+def read_raw_day(infile, ghi_columns):
+    dtypes = dict([(c, 'int64') for c in time_columns] + \
+            [(g, 'float64') for g in ghi_columns])
+    t0 = time.time()
+    df = pd.read_csv(infile, header=None, names=data_columns, \
+            usecols=time_columns + ghi_columns, dtype=dtypes)
+    snc.account_io('in', infile, len(df), time.time() - t0)
+
+    dt = get_datetime(df)
+    df = pd.DataFrame(dict([(g, df[g].to_numpy()) for g in ghi_columns]), \
+            index=pd.Index(dt, name='datetime'))
     # small negative values are truncated to 0
     df[df.lt(0) & df.gt(-1)] = 0
     # large negative values are errors
     rem_neg_cols = df.lt(0).sum().gt(0).sum()
-    if rem_neg_cols > 0:
-        snc.save_csv(df, "{}/{}.csv".format(rejectpath, day))
+    return df, rem_neg_cols > 0
+
+def format_data(infile,outpath, ghi_columns, rejectpath, ext):
+    base = os.path.basename(infile)
+    day = os.path.splitext(base)[0]
+    df, rejected = read_raw_day(infile, ghi_columns)
+    if rejected:
+        snc.save_data(df, "{}/{}.{}".format(rejectpath, day, ext))
     else:
-        snc.save_csv(df, "{}/{}.csv".format(outpath, day))
+        snc.save_data(df, "{}/{}.{}".format(outpath, day, ext))
+
+# Interface used by the pipeline tool to format the days in memory: the raw
+# files of the dataset and the formatted frame of one of them
+def get_raw_files(dtset):
+    return glob.glob("{}/*.txt".format(dtset['path']))
+
+def format_day(infile, fconfig):
+    ghi_columns = ["GHI {}".format(sta) for sta in fconfig['stations']]
+    return read_raw_day(infile, ghi_columns)
 
 def nrelformat(dtset, fconfig, npjobs):
     path = dtset['path']
     print("Input files:")
-    infiles  = glob.glob("{}/*.txt".format(path))
+    infiles  = get_raw_files(dtset)
     print(infiles)
 
     outpath = fconfig['outpath']
@@ -70,5 +99,16 @@ def nrelformat(dtset, fconfig, npjobs):
     stations = fconfig['stations']
     ghi_columns = ["GHI {}".format(sta) for sta in stations]
 
-    arglist = [(f, outpath, ghi_columns, rejectpath) for f in infiles]
-    snc.runjobs(format_data, arglist, npjobs)
+    ext = snc.get_storage(dtset)
+    arglist = [(f,) for f in infiles]
+    shared = (outpath, ghi_columns, rejectpath, ext)
+
+    code = snc.get_code_version([__file__, snc.__file__])
+    key = snc.get_hash([dtset, fconfig, code])
+    jobs = []
+    for f in infiles:
+        day = os.path.splitext(os.path.basename(f))[0]
+        outputs = ["{}/{}.{}".format(p, day, ext) for p in [outpath, rejectpath]]
+        jobs.append((day, key, [f], outputs))
+    cfile = snc.get_cache_fname(outpath, 'format')
+    snc.runjobs_cached(format_data, arglist, jobs, cfile, npjobs, shared)
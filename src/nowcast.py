@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import optparse
+import sys
+import time
+import glob
+import warnings
+import numpy as np
+import pandas as pd
+import joblib
+from pytimeparse.timeparse import timeparse
+import solarnc as snc
+import fselect as fs
+import extend as ext
+
+def parse_options():
+    usage_str = "%prog -c json_config_file [-r set | -f input_file] [-o file]"
+    parser = optparse.OptionParser(usage_str)
+    parser.add_option("-c", dest="config", type="string",
+            help="path to the json file with the configuration parameters")
+    parser.add_option("-r", dest="replay", type="choice",
+            choices=["train", "test", "all"],
+            help="replay the formatted days of the given set as a live feed")
+    parser.add_option("-f", dest="infile", type="string",
+            help="csv file with new samples (datetime and GHI columns) that "
+            "is followed as it grows, - for stdin")
+    parser.add_option("-o", dest="outfile", type="string",
+            help="output csv file for the forecasts (default stdout)")
+
+    options, args  = parser.parse_args()
+    if not options.config: parser.error("missing json config file")
+    if not options.replay and not options.infile:
+        parser.error("missing input: replay set or input file")
+    return (options, args)
+
+# Ring buffer with the last lags resampled rows. Each row is stored twice, so
+# that the whole window is always a contiguous slice of the buffer.
+class RingBuffer:
+    def __init__(self, lags, ncols):
+        self.lags = lags
+        self.data = np.full((2 * lags, ncols), np.nan)
+        self.pos = 0
+        self.count = 0
+
+    def push(self, row):
+        self.data[self.pos] = row
+        self.data[self.pos + self.lags] = row
+        self.pos = (self.pos + 1) % self.lags
+        self.count += 1
+
+    # rows from the oldest to the newest
+    def window(self):
+        return self.data[self.pos:self.pos + self.lags]
+
+    def full(self):
+        return self.count >= self.lags
+
+class Nowcaster:
+    def __init__(self, config, stations):
+        fsconfig = config['fselect']
+        self.period = pd.Timedelta(fsconfig['period'])
+        self.lags = int(timeparse(fsconfig['window']) / \
+                timeparse(fsconfig['period']))
+        self.lagged = fs.get_lagged_vars(stations, fsconfig)
+        self.unlagged = fs.get_unlagged_vars(stations, fsconfig)
+        self.columns = self.lagged + \
+                [c for c in self.unlagged if c not in self.lagged]
+        self.uidx = [self.columns.index(c) for c in self.unlagged]
+        self.nl = len(self.lagged)
+        self.buf = RingBuffer(self.lags, len(self.columns))
+        self.x = np.empty((1, self.nl * self.lags + len(self.unlagged)))
+
+        self.stations = stations
+        self.functions = config['extend']['functions'] \
+                if 'extend' in config else []
+
+        target = fsconfig['forecasting target']
+        self.targets = ["{} {} {}".format(target['variable'], sta, h) \
+                for h, i in fs.get_horizons(fsconfig) \
+                for sta in target['stations']]
+
+        tconfig = config['train']
+        self.models = []
+        for m in tconfig['models']:
+            mfile = "{}/{}.joblib".format(tconfig['outpath'], m['filename'])
+            self.models.append((m['filename'], joblib.load(mfile)))
+
+        self.label = None
+        self.T = None
+        # time of each tick and accumulated time of its steps, in seconds
+        self.times = dict((k, 0.0) for k in ['extend', 'features', 'predict'])
+        self.ticks = []
+
+    # the feature vector has the same layout as the rows of the features
+    # files generated by fselect: lags of each lagged variable, from the
+    # newest to the oldest, followed by the unlagged variables
+    def features(self):
+        win = self.buf.window()
+        nlag = self.nl * self.lags
+        self.x[0, :nlag] = win[::-1, :self.nl].T.ravel()
+        self.x[0, nlag:] = win[-1, self.uidx]
+        return self.x
+
+    # batch holds the raw samples of one period, extended with the same
+    # functions of the extend phase and averaged as fselect does
+    def add_period(self, start, batch):
+        if self.T is None:
+            self.T = pd.Series(batch.index).diff().min()
+            if pd.isnull(self.T):
+                self.T = pd.Timedelta(0)
+        t0 = time.perf_counter()
+        for f in self.functions:
+            batch = ext.apply_function(batch, f, self.stations)
+        row = batch.reindex(columns=self.columns).mean().to_numpy()
+        self.times['extend'] += time.perf_counter() - t0
+        self.push(start, row)
+
+    def push(self, start, row):
+        if self.label is not None:
+            # empty periods are pushed as missing values
+            missing = int((start - self.label) / self.period) - 1
+            for i in range(min(missing, self.lags)):
+                self.buf.push(np.nan)
+        self.label = start
+        self.buf.push(row)
+
+    def forecast(self):
+        if not self.buf.full():
+            return None
+        t0 = time.perf_counter()
+        x = self.features()
+        t1 = time.perf_counter()
+        self.times['features'] += t1 - t0
+        if np.isnan(x).any():
+            return None
+        res = [(name, m.predict(x)[0]) for name, m in self.models]
+        self.times['predict'] += time.perf_counter() - t1
+        return res
+
+    def get_time(self):
+        return self.label + self.period - self.T
+
+def replay_samples(config, stations, dataset):
+    dtset = config['dataset']
+    tzone = dtset['timezone']
+    ext = snc.get_storage(dtset)
+    path = config['format']['outpath']
+    if dataset == 'all':
+        infiles = sorted(glob.glob("{}/*.{}".format(path, ext)))
+    else:
+        fname = "{}/{}set.csv".format(config['split']['outpath'], dataset)
+        infiles = ["{}/{}.{}".format(path, d, ext) \
+                for d in sorted(snc.read_list(fname))]
+    columns = ["GHI {}".format(sta['name']) for sta in stations]
+    for f in infiles:
+        df = snc.read_data(f, tzone)[columns]
+        yield df
+
+def get_samples(lines, header, tzone):
+    rows = [l.strip().split(',') for l in lines if l.strip()]
+    df = pd.DataFrame(rows, columns=header).set_index(header[0])
+    df.index = pd.to_datetime(df.index, utc=True).tz_convert(tzone)
+    return df.astype(float)
+
+# The file may be read while a line is being written, so the text after the
+# last newline is kept until the rest of the line arrives. stdin is read line
+# by line, and its last line is complete at the end of the input.
+def follow_samples(fname, tzone):
+    f = sys.stdin if fname == '-' else open(fname, 'r')
+    header = f.readline().strip().split(',')
+    pending = ''
+    while True:
+        data = f.readline() if f is sys.stdin else f.read()
+        if len(data) == 0:
+            if f is sys.stdin:
+                if pending.strip():
+                    yield get_samples([pending], header, tzone)
+                return
+            time.sleep(0.1)
+            continue
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        if any(l.strip() for l in lines):
+            yield get_samples(lines, header, tzone)
+
+def run(nc, samples, out):
+    out.write(",".join(["datetime", "model"] + nc.targets) + "\n")
+    batch = []
+    start = None
+    for df in samples:
+        bins = df.index.floor(nc.period)
+        for b, chunk in df.groupby(bins, sort=True):
+            if start is not None and b != start:
+                emit(nc, start, pd.concat(batch), out)
+                batch = []
+            start = b
+            batch.append(chunk)
+    if start is not None:
+        emit(nc, start, pd.concat(batch), out)
+
+def emit(nc, start, batch, out):
+    t0 = time.perf_counter()
+    nc.add_period(start, batch)
+    res = nc.forecast()
+    nc.ticks.append(time.perf_counter() - t0)
+    if res is None:
+        return
+    t = nc.get_time()
+    for name, y in res:
+        y = np.atleast_1d(y)
+        out.write("{},{},{}\n".format(t, name, ",".join(str(v) for v in y)))
+    out.flush()
+
+def main(options, args):
+    config = snc.load_config(options.config)
+    print("Correct config format", file=sys.stderr)
+
+    dtset = config['dataset']
+    fconfig = config['format']
+    stations = [sta for sta in dtset['stations'] \
+            if sta['name'] in fconfig['stations']]
+
+    # models trained from data frames warn on every predict with an array
+    warnings.filterwarnings("ignore", message="X does not have valid feature")
+    nc = Nowcaster(config, stations)
+    print("Window of {} periods of {}".format(nc.lags, nc.period), \
+            file=sys.stderr)
+    print("Models: {}".format([name for name, m in nc.models]), \
+            file=sys.stderr)
+
+    if options.replay:
+        samples = replay_samples(config, stations, options.replay)
+    else:
+        samples = follow_samples(options.infile, dtset['timezone'])
+
+    out = open(options.outfile, 'w') if options.outfile else sys.stdout
+    try:
+        run(nc, samples, out)
+    except KeyboardInterrupt:
+        pass
+    # the first period of each day also computes the solar geometry of the
+    # rest of the day, so the median is the usual latency of a period
+    if len(nc.ticks) > 0:
+        n = len(nc.ticks)
+        steps = ", ".join("{} {:.2f}".format(k, 1e3 * v / n) \
+                for k, v in nc.times.items())
+        print("Tick time: mean {:.2f} ms ({}), median {:.2f} ms, max {:.2f} "
+                "ms over {} periods".format(1e3 * np.mean(nc.ticks), steps, \
+                1e3 * np.median(nc.ticks), 1e3 * np.max(nc.ticks), n), \
+                file=sys.stderr)
+
+if __name__ == "__main__":
+    main(*parse_options())
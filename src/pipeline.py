@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import optparse
+import os
+import glob
+import multiprocessing as mp
+import solarnc as snc
+import extend
+import split
+import fselect
+
+phases = ['format', 'extend', 'split', 'fselect', 'train', 'test']
+day_phases = ['format', 'extend', 'fselect']
+
+def parse_options():
+    usage_str = "%prog -c json_config_file [-j num_jobs] [-f first_phase] "\
+            "[-l last_phase] [-k]"
+    parser = optparse.OptionParser(usage_str)
+    parser.add_option("-c", dest="config", type="string",
+            help="path to the json file with the configuration parameters")
+    parser.add_option("-j", dest="npjobs", type="int",
+            help="number of parallel jobs to use", default = mp.cpu_count())
+    parser.add_option("-b", dest="backend", type="choice",
+            choices=["pool", "futures"], default="pool",
+            help="parallel backend: pool (multiprocessing) or futures")
+    parser.add_option("-f", dest="first", type="choice", choices=phases,
+            default=phases[0], help="first phase to run")
+    parser.add_option("-l", dest="last", type="choice", choices=phases,
+            default=phases[-1], help="last phase to run")
+    parser.add_option("-k", dest="keep", action="store_true", default=False,
+            help="write the formatted and extended files even if they are "
+            "not needed by the following phases")
+
+    options, args  = parser.parse_args()
+    if not options.config: parser.error("missing json config file")
+    if phases.index(options.first) > phases.index(options.last):
+        parser.error("first phase after the last one")
+    return (options, args)
+
+# The day phases of the range (format, extend and fselect) run as a single
+# job for each day: the day is formatted, extended and its features selected
+# in memory. The formatted and extended files are only written when the chain
+# ends before fselect or when write is set.
+def run_chain(infile, chain, config, write):
+    dtset = config['dataset']
+    timezone = dtset['timezone']
+    fconfig = config['format']
+    stations = [sta for sta in dtset['stations'] \
+            if sta['name'] in fconfig['stations']]
+    ext = snc.get_storage(dtset)
+    extpath = snc.get_extend_path(config)
+    day = os.path.splitext(os.path.basename(infile))[0]
+    fname = "{}/{}.{}".format(fconfig['outpath'], day, ext)
+
+    if chain[0] == 'format':
+        module = __import__(fconfig['module'])
+        df, rejected = module.format_day(infile, fconfig)
+        if rejected:
+            snc.save_data(df, "{}/{}.{}".format(fconfig['rejectpath'], day, \
+                    ext))
+            return
+        # same timezone as the frames read from the formatted files
+        df.index = df.index.tz_convert(timezone)
+        if write:
+            snc.save_data(df, fname)
+    else:
+        df = snc.read_data(fname, timezone)
+
+    if 'extend' in chain:
+        functions = config['extend']['functions']
+        if write and extpath is not None:
+            extend.add_new_variables(fname, stations, timezone, functions, \
+                    extpath)
+            df = snc.read_day(fname, timezone, extpath)
+        else:
+            newdf = df.copy()
+            for f in functions:
+                newdf = extend.apply_function(newdf, f, stations)
+            if write and not newdf.equals(df):
+                snc.save_data(newdf, fname)
+            df = newdf
+
+    if 'fselect' in chain:
+        fselect.fselect_frame(df, fname, stations, config['fselect'])
+
+def get_chain_outputs(day, chain, config, write):
+    ext = snc.get_storage(config['dataset'])
+    fconfig = config['format']
+    outputs = []
+    if chain[0] == 'format':
+        outputs.append("{}/{}.{}".format(fconfig['rejectpath'], day, ext))
+    if write:
+        outputs.append("{}/{}.{}".format(fconfig['outpath'], day, ext))
+        extpath = snc.get_extend_path(config)
+        if 'extend' in chain and extpath is not None:
+            outputs.append("{}/{}.json".format(extpath, day))
+    if 'fselect' in chain:
+        outputs += ["{}/{}_{}.{}".format(config['fselect']['outpath'], day, \
+                t, ext) for t in ['features', 'targets']]
+    return outputs
+
+def get_chain_outpath(chain, config):
+    if chain[-1] == 'fselect':
+        return config['fselect']['outpath']
+    if chain[-1] == 'extend' and snc.get_extend_path(config) is not None:
+        return snc.get_extend_path(config)
+    return config['format']['outpath']
+
+def get_chain_infiles(chain, config):
+    if chain[0] == 'format':
+        module = __import__(config['format']['module'])
+        return module.get_raw_files(config['dataset'])
+    ext = snc.get_storage(config['dataset'])
+    return glob.glob("{}/*.{}".format(config['format']['outpath'], ext))
+
+def chain_days(chain, config, options):
+    fconfig = config['format']
+    write = options.keep or chain[-1] != 'fselect'
+    for path in [fconfig['outpath'], fconfig.get('rejectpath')]:
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+    if 'fselect' in chain:
+        fselect.check_config(config['fselect'])
+    outpath = get_chain_outpath(chain, config)
+    snc.start_report(outpath, 'pipeline')
+
+    infiles = get_chain_infiles(chain, config)
+    print("Chaining {} for {} days".format(", ".join(chain), len(infiles)))
+    modules = [__file__, snc.__file__, extend.__file__, fselect.__file__, \
+            __import__(fconfig['module']).__file__]
+    if 'extend' in chain:
+        modules += [__import__(f['module']).__file__ \
+                for f in config['extend']['functions']]
+    code = snc.get_code_version(modules)
+    key = snc.get_hash([config['dataset'], fconfig, config.get('extend'), \
+            config['fselect'], chain, write, code])
+    jobs = []
+    for f in infiles:
+        day = os.path.splitext(os.path.basename(f))[0]
+        outputs = get_chain_outputs(day, chain, config, write)
+        jobs.append((day, key, [f], outputs))
+    cfile = snc.get_cache_fname(outpath, 'pipeline')
+    snc.runjobs_cached(run_chain, [(f,) for f in infiles], jobs, cfile, \
+            options.npjobs, (chain, config, write))
+
+    # days for the split, formatted files may not have been written
+    ext = snc.get_storage(config['dataset'])
+    if write:
+        return glob.glob("{}/*.{}".format(fconfig['outpath'], ext))
+    days = [os.path.splitext(os.path.basename(f))[0] for f in infiles]
+    return ["{}/{}.{}".format(fconfig['outpath'], d, ext) for d in days \
+            if os.path.exists("{}/{}_features.{}".format(\
+            config['fselect']['outpath'], d, ext))]
+
+def run_phase(phase, options):
+    module = __import__(phase)
+    module.main(optparse.Values({'config': options.config, \
+            'npjobs': options.npjobs, 'backend': options.backend}), [])
+
+def main(options, args):
+    config = snc.load_config(options.config)
+    print("Correct config format")
+
+    selected = phases[phases.index(options.first):\
+            phases.index(options.last) + 1]
+    if 'extend' not in config:
+        selected = [p for p in selected if p != 'extend']
+    chain = [p for p in selected if p in day_phases]
+
+    # formatters without the in memory interface, and the fselect modes
+    # that read the neighbouring days or the column groups from the
+    # formatted files, run as separate phases
+    module = __import__(config['format']['module'])
+    if 'format' in chain and not (hasattr(module, 'format_day') and \
+            hasattr(module, 'get_raw_files')):
+        chain.remove('format')
+    fsconfig = config['fselect']
+    if 'fselect' in chain and (fsconfig.get('continuous', False) or \
+            fsconfig.get('partition', 'days') != 'days'):
+        chain.remove('fselect')
+    if len(chain) < 2:
+        chain = []
+    print("Phases: {}".format(", ".join(selected)))
+
+    infiles = None
+    for phase in selected:
+        if phase in chain:
+            if phase == chain[0]:
+                infiles = chain_days(chain, config, options)
+        elif phase == 'split' and infiles is not None:
+            split.make_split(config, infiles)
+        else:
+            run_phase(phase, options)
+
+if __name__ == "__main__":
+    main(*parse_options())
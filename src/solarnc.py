@@ -1,32 +1,197 @@
 import json
 import os
+import hashlib
 import csv
-import pandas as pd
-import numpy as np
-import jsonschema as jsch
-import pvlib
 import glob
 import multiprocessing as mp
+import traceback
+import sys
+import time
+import atexit
+import resource
+import cProfile
+import pstats
+
+# pandas and numpy are imported by the functions that use them, so the tools
+# that only need the configuration, list, cache and report helpers (split.py)
+# do not pay for their import.
+
+# The validator compiled from the schema is kept for each schema hash, so a
+# process that loads several configurations (pipeline.py, sweep.py) compiles
+# it once. The hashes of the configurations that have been validated are
+# stored in .schema_cache.json, next to the schema, and those configurations
+# are not validated again (nor jsonschema imported) until the schema changes.
+validators = {}
+
+def get_validator(schema_hash, schema):
+    if schema_hash not in validators:
+        import jsonschema as jsch
+        cls = jsch.validators.validator_for(schema)
+        cls.check_schema(schema)
+        validators[schema_hash] = cls(schema)
+    return validators[schema_hash]
 
 def load_config(fname):
     with open(fname, 'r') as f:
         config = json.load(f)
     current_file = os.path.realpath(__file__)
-    schema_path = os.path.dirname(current_file)
-    schema_fname = "{}/../jsons/solarnc_schema.json".format(schema_path)
-    with open(schema_fname, 'r') as f:
-        schema = json.load(f)
-    jsch.validate(config, schema)
+    schema_path = "{}/../jsons".format(os.path.dirname(current_file))
+    schema_fname = "{}/solarnc_schema.json".format(schema_path)
+    with open(schema_fname, 'rb') as f:
+        data = f.read()
+    schema_hash = hashlib.sha1(data).hexdigest()
+    config_hash = get_hash(config)
+
+    cfile = get_cache_fname(schema_path, 'schema')
+    cache = load_cache(cfile)
+    if cache.get('schema') != schema_hash:
+        cache = {'schema': schema_hash, 'configs': []}
+    if config_hash in cache['configs']:
+        return config
+    get_validator(schema_hash, json.loads(data)).validate(config)
+    cache['configs'] = cache['configs'][-999:] + [config_hash]
+    # several processes may validate at the same time, and the schema
+    # directory may not be writable
+    tmpfile = "{}.{}.tmp".format(cfile, os.getpid())
+    try:
+        with open(tmpfile, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmpfile, cfile)
+    except OSError:
+        pass
     return config
 
-def read_csv(infile, tzone):
-    df = pd.read_csv(infile, index_col = "datetime", parse_dates=True)
+def read_csv(infile, tzone, columns=None):
+    import pandas as pd
+    usecols = None if columns is None else ["datetime"] + list(columns)
+    df = pd.read_csv(infile, index_col = "datetime", parse_dates=True,
+            usecols = usecols)
     df.index = df.index.tz_localize('UTC').tz_convert(tzone)
     return df
 
 def save_csv(df, outfile):
     df.to_csv(outfile, header = True, index = True)
 
+def read_parquet(infile, tzone, columns=None):
+    import pandas as pd
+    df = pd.read_parquet(infile, columns = columns)
+    df.index = df.index.tz_convert(tzone)
+    return df
+
+def save_parquet(df, outfile):
+    df.rename_axis('datetime').to_parquet(outfile, index = True)
+
+def read_feather(infile, tzone, columns=None):
+    import pandas as pd
+    if columns is not None:
+        columns = ['datetime'] + list(columns)
+    df = pd.read_feather(infile, columns = columns).set_index('datetime')
+    df.index = df.index.tz_convert(tzone)
+    return df
+
+def save_feather(df, outfile):
+    df.rename_axis('datetime').reset_index().to_feather(outfile)
+
+# storage backends for the per-day files exchanged between phases, selected
+# with the storage property of the dataset (csv by default)
+storage_backends = {
+    'csv': (read_csv, save_csv),
+    'parquet': (read_parquet, save_parquet),
+    'feather': (read_feather, save_feather)
+}
+
+def count_rows(infile):
+    ext = os.path.splitext(infile)[1][1:]
+    if ext == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_metadata(infile).num_rows
+    elif ext == 'feather':
+        import pyarrow.feather as pf
+        return pf.read_table(infile, memory_map=True).num_rows
+    with open(infile, 'rb') as f:
+        return sum(1 for line in f) - 1
+
+# names of the data columns of a file, read from its header or schema
+def get_file_columns(infile):
+    ext = os.path.splitext(infile)[1][1:]
+    if ext == 'parquet':
+        import pyarrow.parquet as pq
+        columns = pq.read_schema(infile).names
+    elif ext == 'feather':
+        import pyarrow.ipc as ipc
+        columns = ipc.open_file(infile).schema.names
+    else:
+        with open(infile, 'r') as f:
+            columns = next(csv.reader(f))
+    return [c for c in columns if c != 'datetime']
+
+def get_storage(dtset):
+    return dtset['storage'] if 'storage' in dtset else 'csv'
+
+# columns restricts the read to the given columns (all by default)
+def read_data(infile, tzone, columns=None):
+    ext = os.path.splitext(infile)[1][1:]
+    t0 = time.time()
+    df = storage_backends[ext][0](infile, tzone, columns)
+    account_io('in', infile, len(df), time.time() - t0)
+    return df
+
+# files are written to a hidden temporary file and renamed, so that a crash
+# never leaves a partially written file
+def save_data(df, outfile):
+    ext = os.path.splitext(outfile)[1][1:]
+    dname, fname = os.path.split(outfile)
+    tmpfile = os.path.join(dname, ".{}.{}.tmp".format(fname, os.getpid()))
+    t0 = time.time()
+    storage_backends[ext][1](df, tmpfile)
+    os.replace(tmpfile, outfile)
+    account_io('out', outfile, len(df), time.time() - t0)
+
+# Extend sidecars. When extend has an outpath, the formatted files are not
+# modified. Instead, each function writes to a sidecar file only the columns
+# it added or changed, and a manifest (day.json) lists the sidecars of each
+# day in the order they have to be applied on the formatted file.
+def get_manifest_fname(extpath, infile):
+    day = os.path.splitext(os.path.basename(infile))[0]
+    return "{}/{}.json".format(extpath, day)
+
+def get_changes(old, new):
+    old = old.reindex(new.index)
+    columns = [c for c in new.columns \
+            if c not in old.columns or not new[c].equals(old[c])]
+    return new[columns]
+
+def apply_changes(df, changes):
+    if not df.index.equals(changes.index):
+        df = df.reindex(changes.index)
+    for c in changes.columns:
+        df[c] = changes[c]
+    return df
+
+# with columns, only those columns are read from the formatted file and from
+# each sidecar (sidecars may still change the index of the day)
+def read_day(infile, tzone, extpath=None, columns=None):
+    def read(fname):
+        if columns is None:
+            return read_data(fname, tzone)
+        available = get_file_columns(fname)
+        return read_data(fname, tzone, [c for c in columns if c in available])
+
+    df = read(infile)
+    if extpath is not None:
+        with open(get_manifest_fname(extpath, infile), 'r') as f:
+            sidecars = json.load(f)
+        for sc in sidecars:
+            df = apply_changes(df, read(sc))
+    if columns is not None:
+        df = df[columns]
+    return df
+
+def get_extend_path(config):
+    if 'extend' in config and 'outpath' in config['extend']:
+        return config['extend']['outpath']
+    return None
+
 def save_list(l, fname):
     with open(fname, 'w') as f:
         wr = csv.writer(f, quoting=csv.QUOTE_ALL)
@@ -38,28 +203,176 @@ def read_list(fname):
         l = list(reader)
     return l[0]
 
+# Solar position and clear sky values only depend on the location of the
+# station and on the timestamps. They are computed for whole hours (UTC) on
+# the grid of the sampling period and the values of the timestamps of the frame
+# are taken from them, so each hour of each location is computed once: other
+# clear sky models, reruns, days with missing samples and the periods of
+# nowcast.py reuse it. Frames shorter than an hour (the periods of nowcast.py)
+# also compute the rest of their UTC day, so the next ones only take their
+# values. The hours are kept in memory (the last array_memo_size bytes) and, if
+# cachepath is given, as .npz files keyed by the location, the hour, the
+# sampling period and the model. Frames whose timestamps are not on such a grid
+# are computed and cached as a whole.
+array_memo = {}
+array_memo_size = 64 * 2**20
+array_memo_used = 0
+
+def get_grid_hash(index):
+    return hashlib.sha1(index.asi8.tobytes()).hexdigest()
+
+def load_arrays(cachepath, h):
+    import numpy as np
+    if h in array_memo:
+        return array_memo[h]
+    fname = "{}/{}.npz".format(cachepath, h)
+    if cachepath is None or not os.path.exists(fname):
+        return None
+    with np.load(fname) as d:
+        arrays = dict(d)
+    store_arrays(None, h, arrays)
+    return arrays
+
+def store_arrays(cachepath, h, arrays):
+    global array_memo_used
+    import numpy as np
+    size = sum(a.nbytes for a in arrays.values())
+    while len(array_memo) > 0 and array_memo_used + size > array_memo_size:
+        old = array_memo.pop(next(iter(array_memo)))
+        array_memo_used -= sum(a.nbytes for a in old.values())
+    array_memo[h] = arrays
+    array_memo_used += size
+    if cachepath is None:
+        return
+    if not os.path.exists(cachepath):
+        os.makedirs(cachepath, exist_ok=True)
+    fname = "{}/{}.npz".format(cachepath, h)
+    tmpfile = "{}.{}.tmp".format(fname, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmpfile, fname)
+
+def cached_arrays(cachepath, key, fun):
+    h = get_hash(key)
+    arrays = load_arrays(cachepath, h)
+    if arrays is None:
+        arrays = fun()
+        store_arrays(cachepath, h, arrays)
+    return arrays
+
+# hour of each timestamp and its position in the grid of that hour, or None
+# if the timestamps are not on a grid of a period that divides the hour
+def get_hour_grid(index):
+    import numpy as np
+    hour = 3600 * 10**9
+    if len(index) < 2:
+        return None
+    ns = index.asi8
+    step = int(np.diff(ns).min())
+    if step <= 0 or hour % step != 0 or np.any(ns % step != 0):
+        return None
+    hours = ns - ns % hour
+    return hours, (ns - hours) // step, step
+
+# the hours that are not cached are computed with a single call of fun
+def grid_arrays(cachepath, key, index, fun):
+    import pandas as pd
+    import numpy as np
+    grid = get_hour_grid(index)
+    if grid is None:
+        return cached_arrays(cachepath, key + [get_grid_hash(index)], \
+                lambda: fun(index))
+    hours, pos, step = grid
+    hour = 3600 * 10**9
+    day = 24 * hour
+    uhours = np.unique(hours)
+    n = hour // step
+    keys = [get_hash(key + [int(h), step]) for h in uhours]
+    blocks = [load_arrays(cachepath, k) for k in keys]
+    missing = [(uhours[i], keys[i]) for i, b in enumerate(blocks) if b is None]
+    if len(missing) > 0:
+        if index.asi8[-1] - index.asi8[0] < hour:
+            end = uhours[-1] - uhours[-1] % day + day
+            for h in range(int(uhours[-1]) + hour, int(end), hour):
+                k = get_hash(key + [h, step])
+                if load_arrays(cachepath, k) is None:
+                    missing.append((h, k))
+        ns = np.concatenate([h + np.arange(n) * step for h, k in missing])
+        arrays = fun(pd.DatetimeIndex(ns).tz_localize('UTC')\
+                .tz_convert(index.tz))
+        # the blocks are taken from here and not from the memo, which may
+        # have already dropped the first ones if the frame is larger than it
+        computed = {}
+        for j, (h, k) in enumerate(missing):
+            computed[k] = dict((name, values[j * n:(j + 1) * n].copy()) \
+                    for name, values in arrays.items())
+            store_arrays(cachepath, k, computed[k])
+        blocks = [computed[k] if b is None else b \
+                for k, b in zip(keys, blocks)]
+
+    out = {}
+    for h, arrays in zip(uhours, blocks):
+        sel = hours == h
+        for name, values in arrays.items():
+            if name not in out:
+                out[name] = np.empty((len(index),) + values.shape[1:], \
+                        dtype=values.dtype)
+            out[name][sel] = values[pos[sel]]
+    return out
+
+# with precision, station coordinates are rounded to that number of decimals
+# so that co-located stations share the same cached values
+def get_location(sta, precision):
+    latitude = sta["latitude"]
+    longitude = sta["longitude"]
+    if precision is not None:
+        latitude = round(latitude, precision)
+        longitude = round(longitude, precision)
+    altitude = sta["MASL"] if "MASL" in sta else 0
+    return latitude, longitude, altitude
+
 # pvlib provides: ‘ineichen’, ‘haurwitz’, ‘simplified_solis'
-def csm_pvlib(df, skip_existing, stations, models, position):
+def csm_pvlib(df, skip_existing, stations, models, position, cachepath=None,\
+        precision=None):
+    # pvlib takes longer to import than the rest of the modules, and only
+    # the extend phase uses it
+    import pvlib
+    import pandas as pd
+    import numpy as np
+
     def elevation_azimuth(df, solpos, staname, skip_existing):
         ecol = 'nelevation {}'.format(staname)
         acol = 'nazimuth {}'.format(staname)
         if position and (ecol not in df.columns or not skip_existing):
-            df[ecol] = solpos['apparent_elevation'] / 90
-            df[acol] = solpos['azimuth'] / 360
+            new[ecol] = solpos['apparent_elevation'].to_numpy() / 90
+            new[acol] = solpos['azimuth'].to_numpy() / 360
+
+    def solar_position(index, location, pressure):
+        latitude, longitude, altitude = location
+        solpos = pvlib.solarposition.get_solarposition(index,\
+                latitude, longitude, altitude, pressure)
+        return dict((c, solpos[c].to_numpy()) for c in \
+                ['apparent_elevation', 'apparent_zenith', 'azimuth'])
+
+    def get_solpos(index, location, pressure):
+        solpos = grid_arrays(cachepath, ['solpos', location], index, \
+                lambda i: solar_position(i, location, pressure))
+        return pd.DataFrame(solpos, index=index)
 
-    def csm(df, model, sta, solpos, pressure, dni_extra):
-        latitude = sta["latitude"]
-        longitude = sta["longitude"]
-        altitude = sta["MASL"] if "MASL" in sta else 0
+    def csm(index, model, location, pressure):
+        latitude, longitude, altitude = location
+        solpos = get_solpos(index, location, pressure)
         apparent_elevation = solpos['apparent_elevation']
         apparent_zenith = solpos['apparent_zenith']
+        if model in ['ineichen', 'simplified_solis']:
+            dni_extra = pvlib.irradiance.get_extra_radiation(index)
 
         if model == 'ineichen':
             airmass = pvlib.atmosphere.get_relative_airmass(apparent_zenith)
             airmass = pvlib.atmosphere.get_absolute_airmass(airmass, \
                     pressure)
             linke_turbidity = pvlib.clearsky.lookup_linke_turbidity(\
-                    df.index, latitude, longitude)
+                    index, latitude, longitude)
             ghi_csm = pvlib.clearsky.ineichen(apparent_zenith, airmass,\
                     linke_turbidity, altitude, dni_extra)['ghi']
         elif model == 'simplified_solis':
@@ -73,17 +386,20 @@ def csm_pvlib(df, skip_existing, stations, models, position):
             print("Error: {} model not supportd".format(model))
             raise ValueError
         ghi_csm[ghi_csm < np.finfo(float).eps] = 0
-        return ghi_csm.round(4)
+        return {'ghi': ghi_csm.round(4).to_numpy()}
 
-    if 'ineichen' in models or 'simplified_solis' in models:
-        dni_extra = pvlib.irradiance.get_extra_radiation(df.index)
+    T = df.index.inferred_freq
 
+    # the new columns are computed as arrays and added at once (a single
+    # concat unless some of them replace existing ones), which is faster for
+    # the short frames of nowcast.py
+    new = {}
+    updated = False
     for sta in stations:
         staname = sta['name']
-        altitude = sta["MASL"] if "MASL" in sta else 0
-        pressure = pvlib.atmosphere.alt2pres(altitude)
-        solpos = pvlib.solarposition.get_solarposition(df.index,\
-                sta["latitude"], sta["longitude"], altitude, pressure)
+        location = get_location(sta, precision)
+        pressure = pvlib.atmosphere.alt2pres(location[2])
+        solpos = get_solpos(df.index, location, pressure)
         elevation_azimuth(df, solpos, staname, skip_existing)
 
         for model in models:
@@ -92,47 +408,365 @@ def csm_pvlib(df, skip_existing, stations, models, position):
             kcol = "K_{} {}".format(model, staname)
             if skip_existing and csmcol in df.columns:
                 continue
-            df[csmcol] = csm(df, model, sta, solpos, pressure, dni_extra)
-            df[kcol] = df[ghicol]/df[csmcol].replace({0: np.finfo(float).eps})
-            df[kcol] = df[kcol].round(4)
+            ghi_csm = grid_arrays(cachepath, ['csm', model, location], \
+                    df.index, lambda i: csm(i, model, location, pressure))
+            csmv = ghi_csm['ghi'].reshape(len(df))
+            k = df[ghicol].to_numpy(dtype=float) / \
+                    np.where(csmv == 0, np.finfo(float).eps, csmv)
+            k = k.round(4)
             # sunrise and sunset give unreasonable high k values
             # we remove those values and interpolate with the neighbours
-            T = df.index.inferred_freq
-            df.drop(df[df[kcol] > 2].index, inplace=True)
-            df = df.resample(T).interpolate(axis=0)
+            k[k > 2] = np.nan
+            new[csmcol] = csmv
+            new[kcol] = k
+            updated = True
+    if any(c in df.columns for c in new):
+        df = df.assign(**new)
+    elif len(new) > 0:
+        df = pd.concat([df, pd.DataFrame(new, index=df.index)], axis=1)
+    if updated:
+        df = df.resample(T).interpolate(axis=0)
     return df
 
-def run_cbk_unpack(tup):
-    cbk, argtup = tup
-    cbk(*argtup)
+# Phase cache. Each phase keeps a json file in its output path with an entry
+# per job (a day file or a model). The entry stores a hash of the config and
+# code used, the signature (size, mtime) of the inputs and the outputs that
+# were produced. A job is skipped only if all of them still match.
+def get_hash(obj):
+    s = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()
 
-def runjobs(cbk, arglist, npjobs):
+def get_code_version(files):
+    h = hashlib.sha1()
+    for fname in sorted(set(os.path.realpath(f) for f in files)):
+        with open(fname, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def get_cache_fname(outpath, phase):
+    return "{}/.{}_cache.json".format(outpath, phase)
+
+def load_cache(cfile):
+    if not os.path.exists(cfile):
+        return {}
+    with open(cfile, 'r') as f:
+        return json.load(f)
+
+def save_cache(cache, cfile):
+    tmpfile = "{}.tmp".format(cfile)
+    with open(tmpfile, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmpfile, cfile)
+
+def is_cached(cache, name, key, inputs):
+    if name not in cache:
+        return False
+    entry = cache[name]
+    return entry['key'] == key and \
+            entry['inputs'] == get_files_signature(inputs) and \
+            len(entry['outputs']) > 0 and \
+            all(os.path.exists(o) for o in entry['outputs'])
+
+def update_cache(cache, name, key, inputs, outputs):
+    cache[name] = {'key': key, 'inputs': get_files_signature(inputs),
+            'outputs': [o for o in outputs if os.path.exists(o)]}
+
+# jobs contains a (name, key, inputs, outputs) tuple for each element of
+# arglist, where outputs are all the files the job may produce
+def runjobs_cached(cbk, arglist, jobs, cfile, npjobs, shared=()):
+    cache = load_cache(cfile)
+    todo = [(a, j) for a, j in zip(arglist, jobs) \
+            if not is_cached(cache, j[0], j[1], j[2])]
+    print("Cached: {}/{}".format(len(arglist) - len(todo), len(arglist)))
+    if report is not None:
+        report['cached'] += len(arglist) - len(todo)
+
+    def done(i, result):
+        name, key, inputs, outputs = todo[i][1]
+        update_cache(cache, name, key, inputs, outputs)
+    try:
+        runjobs(cbk, [a for a, j in todo], npjobs, shared, done)
+    finally:
+        save_cache(cache, cfile)
+
+# Job executor. The callback and the arguments shared by all the jobs (shared)
+# are sent once to each worker by the pool initializer, so that each task only
+# carries its own arguments. A job is called as cbk(*argtup, *shared).
+# Workers are processes from a multiprocessing pool or, with the futures
+# backend, from a concurrent.futures.ProcessPoolExecutor.
+jobs_backend = 'pool'
+worker_job = None
+
+def init_worker(cbk, shared):
+    global worker_job
+    worker_job = (cbk, tuple(shared))
+
+# the job returns its error (or None), its result and its run report stats
+def run_job(argtup):
+    global job_stats
+    cbk, shared = worker_job
+    saved, job_stats = job_stats, new_job_stats()
+    prof = cProfile.Profile() if profiling() else None
+    wall, cpu = time.time(), time.process_time()
+    try:
+        if prof is not None:
+            prof.enable()
+        result = cbk(*(tuple(argtup) + shared))
+    except Exception:
+        return traceback.format_exc(), None, None
+    finally:
+        if prof is not None:
+            prof.disable()
+        stats, job_stats = job_stats, saved
+    stats['wall'] = time.time() - wall
+    stats['cpu'] = time.process_time() - cpu
+    stats['compute_time'] = stats['wall'] - stats['read_time'] - \
+            stats['save_time']
+    stats['pid'] = os.getpid()
+    if prof is not None:
+        stats['profile'] = get_top_functions(pstats.Stats(prof), 10)
+    return None, result, stats
+
+def get_chunksize(njobs, npjobs):
+    return max(1, njobs // (npjobs * 4))
+
+def execjobs(cbk, arglist, npjobs, shared):
+    initargs = (cbk, shared)
+    if npjobs <= 1 or len(arglist) <= 1:
+        init_worker(*initargs)
+        for argtup in arglist:
+            yield run_job(argtup)
+        return
+
+    chunksize = get_chunksize(len(arglist), npjobs)
+    if jobs_backend == 'futures':
+        import concurrent.futures as cf
+        with cf.ProcessPoolExecutor(npjobs, initializer=init_worker, \
+                initargs=initargs) as ex:
+            yield from ex.map(run_job, arglist, chunksize=chunksize)
+    else:
+        with mp.Pool(npjobs, initializer=init_worker, initargs=initargs) as p:
+            yield from p.imap(run_job, arglist, chunksize)
+            p.close()
+            p.join()
+
+# done(i, result) is called in the main process when the i-th job finishes
+# correctly, with the value returned by the callback
+def runjobs(cbk, arglist, npjobs, shared=(), done=None):
     nj = len(arglist)
-    l = list(zip([cbk] * nj, arglist))
     j = 0;
+    failed = []
     print("\rDone: {}/{}".format(j,nj), end='')
-    if npjobs > 1:
-        p = mp.Pool(npjobs)
-        for x in p.imap(run_cbk_unpack, l):
-            j += 1
-            print("\rDone: {}/{}".format(j,nj), end='')
-    else:
-        for argtup in arglist:
-            cbk(*argtup)
-            j += 1
-            print("\rDone: {}/{}".format(j,nj), end='')
+    jobs = execjobs(cbk, arglist, npjobs, shared)
+    for i, (error, result, stats) in enumerate(jobs):
+        record = {'type': 'job', 'function': cbk.__name__, \
+                'args': list(arglist[i])}
+        if error is not None:
+            failed.append(arglist[i][0])
+            print("\nError: job {} failed\n{}".format(arglist[i][0], error))
+            record['error'] = error
+        else:
+            record.update(stats)
+            if done is not None:
+                done(i, result)
+        add_report_job(record)
+        j += 1
+        print("\rDone: {}/{}".format(j,nj), end='')
     print("")
+    if len(failed) > 0:
+        raise RuntimeError("{} jobs failed: {}".format(len(failed), failed))
+
+# Run reports. A tool opens the report of its phase with start_report, a jsonl
+# file in its output path with one line per record: the start of the run,
+# every job run by runjobs, the models trained and a summary of the run, that
+# is written at exit. The reads and writes of read_data and save_data are
+# accounted (rows, bytes and time) to the job that does them, or to the main
+# process of the phase, and the compute time of a job is the rest of its wall
+# time. Records are appended with a single write, so that the processes of a
+# phase can share the file. If the SOLARNC_PROFILE environment variable is
+# set, the main process is profiled with cProfile (phase.prof in the output
+# path) and every job records the functions with the largest cumulative time.
+report = None
+report_fname = None
+job_stats = None
+io_counters = ['rows_in', 'bytes_in', 'read_time', 'rows_out', 'bytes_out',
+        'save_time']
+
+def profiling():
+    return os.environ.get('SOLARNC_PROFILE', '') not in ['', '0']
+
+def get_report_fname(outpath, phase):
+    return "{}/{}_report.jsonl".format(outpath, phase)
+
+def new_job_stats():
+    return dict((c, 0) for c in io_counters)
+
+def account_io(direction, fname, nrows, seconds):
+    if job_stats is None:
+        return
+    job_stats['rows_' + direction] += nrows
+    job_stats['bytes_' + direction] += os.path.getsize(fname)
+    job_stats['read_time' if direction == 'in' else 'save_time'] += seconds
+
+def get_top_functions(stats, n):
+    functions = []
+    for (fname, line, name), (cc, nc, tt, ct, callers) in \
+            stats.stats.items():
+        functions.append({'function': "{}:{}({})".format(\
+                os.path.basename(fname), line, name), 'ncalls': nc, \
+                'tottime': tt, 'cumtime': ct})
+    functions.sort(key=lambda f: -f['cumtime'])
+    return functions[:n]
+
+def get_cpu_time():
+    cpu = 0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        ru = resource.getrusage(who)
+        cpu += ru.ru_utime + ru.ru_stime
+    return cpu
+
+def write_report(record):
+    if report_fname is None:
+        return
+    with open(report_fname, 'a') as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+# a process that runs several phases (pipeline.py) ends the report of the
+# previous phase when the next one starts
+def start_report(outpath, phase):
+    global report, report_fname, job_stats
+    end_report()
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
+    report_fname = get_report_fname(outpath, phase)
+    open(report_fname, 'w').close()
+    report = {'phase': phase, 'outpath': outpath, 'pid': os.getpid(), \
+            'wall': time.time(), 'cpu': get_cpu_time(), 'jobs': 0, \
+            'failed': 0, 'cached': 0, 'totals': new_job_stats(), \
+            'profiler': None}
+    job_stats = new_job_stats()
+    write_report({'type': 'run', 'phase': phase, 'pid': os.getpid(), \
+            'date': time.strftime("%Y-%m-%dT%H:%M:%S"), 'argv': sys.argv})
+    if profiling():
+        report['profiler'] = cProfile.Profile()
+        report['profiler'].enable()
+    atexit.register(end_report)
+
+def add_report_job(record):
+    write_report(record)
+    if report is None:
+        return
+    report['jobs'] += 1
+    if 'error' in record:
+        report['failed'] += 1
+        return
+    for c in io_counters:
+        report['totals'][c] += record[c]
+
+def end_report():
+    global report
+    if report is None or report['pid'] != os.getpid():
+        return
+    totals = report['totals']
+    for c in io_counters:
+        totals[c] += job_stats[c]
+    summary = {'type': 'summary', 'phase': report['phase'], \
+            'wall': time.time() - report['wall'], \
+            'cpu': get_cpu_time() - report['cpu'], 'jobs': report['jobs'], \
+            'failed': report['failed'], 'cached': report['cached']}
+    summary.update(totals)
+    write_report(summary)
+    if report['profiler'] is not None:
+        report['profiler'].disable()
+        report['profiler'].dump_stats("{}/{}.prof".format(report['outpath'], \
+                report['phase']))
+    report = None
 
 def get_feature_target_data(ffiles, tfiles, tzone):
+    import pandas as pd
     l = []
     for f in ffiles:
-        l.append(read_csv(f, tzone))
+        l.append(read_data(f, tzone))
     fdf = pd.concat(l)
 
     l = []
     for f in tfiles:
-        l.append(read_csv(f, tzone))
+        l.append(read_data(f, tzone))
     tdf = pd.concat(l)
 
     return fdf, tdf
 
+
+def get_files_signature(files):
+    sig = []
+    for f in files:
+        st = os.stat(f)
+        sig.append([f, st.st_size, st.st_mtime_ns])
+    return sig
+
+# X, Y and the row index are stored as .npy files in path, together with a
+# matrix.json file describing the inputs they were built from. If the inputs
+# have not changed the arrays are reused, otherwise they are built again
+# reading each day file only once.
+def get_feature_target_memmap(ffiles, tfiles, tzone, path, dtype='float64'):
+    import numpy as np
+    xfname = "{}/X.npy".format(path)
+    yfname = "{}/Y.npy".format(path)
+    ifname = "{}/index.npy".format(path)
+    mfname = "{}/matrix.json".format(path)
+    signature = {'features': get_files_signature(ffiles),
+            'targets': get_files_signature(tfiles), 'dtype': dtype}
+
+    if os.path.exists(mfname):
+        with open(mfname, 'r') as f:
+            meta = json.load(f)
+        if meta['signature'] == signature:
+            return load_feature_target_memmap(path, meta, tzone)
+        os.remove(mfname)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    nrows = [count_rows(f) for f in ffiles]
+    if nrows != [count_rows(f) for f in tfiles]:
+        print("Error: features and targets files have different rows")
+        raise ValueError
+
+    X = Y = None
+    index = np.lib.format.open_memmap(ifname, mode='w+', dtype='int64',
+            shape=(sum(nrows),))
+    row = 0
+    for ff, tf, n in zip(ffiles, tfiles, nrows):
+        fdf = read_data(ff, tzone)
+        tdf = read_data(tf, tzone)
+        if X is None:
+            fcolumns = list(fdf.columns)
+            tcolumns = list(tdf.columns)
+            X = np.lib.format.open_memmap(xfname, mode='w+', dtype=dtype,
+                    shape=(sum(nrows), len(fcolumns)))
+            Y = np.lib.format.open_memmap(yfname, mode='w+', dtype=dtype,
+                    shape=(sum(nrows), len(tcolumns)))
+        X[row:row + n] = fdf[fcolumns].to_numpy(dtype=dtype)
+        Y[row:row + n] = tdf[tcolumns].to_numpy(dtype=dtype)
+        index[row:row + n] = fdf.index.values.astype('datetime64[ns]')\
+                .view('int64')
+        row += n
+    X.flush()
+    Y.flush()
+    index.flush()
+    del X, Y, index
+
+    meta = {'signature': signature, 'features': fcolumns,
+            'targets': tcolumns}
+    with open(mfname, 'w') as f:
+        json.dump(meta, f)
+    return load_feature_target_memmap(path, meta, tzone)
+
+def load_feature_target_memmap(path, meta, tzone):
+    import pandas as pd
+    import numpy as np
+    X = np.load("{}/X.npy".format(path), mmap_mode='r')
+    Y = np.load("{}/Y.npy".format(path), mmap_mode='r')
+    index = np.load("{}/index.npy".format(path))
+    index = pd.to_datetime(index, unit='ns', utc=True).tz_convert(tzone)
+    index.name = 'datetime'
+    return X, Y, index, meta['features'], meta['targets']
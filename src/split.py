@@ -37,19 +37,14 @@ def split_random(infiles, args):
     testset = [os.path.splitext(os.path.basename(f))[0] for f in testset]
     return trainset, testset
 
-def main(options, args):
-    config = snc.load_config(options.config)
-    print("Correct config format")
-
-    fconfig = config['format']
-    infiles  = glob.glob("{}/*.csv".format(fconfig['outpath']))
-    print("Input files:")
-    print(infiles)
-
+# infiles are only used by their names, so the pipeline tool can split days
+# that have not been written to the format outpath
+def make_split(config, infiles):
     spconfig = config['split']
     outpath = spconfig['outpath']
     if not os.path.exists(outpath):
         os.makedirs(outpath)
+    snc.start_report(outpath, 'split')
     trainset_fname = "{}/trainset.csv".format(outpath)
     testset_fname = "{}/testset.csv".format(outpath)
     print("Output to {} and {}".format(trainset_fname, testset_fname))
@@ -69,6 +64,16 @@ def main(options, args):
     if not callable(fun):
         print("method should be a callable python object")
         raise ValueError
+
+    days = sorted(os.path.basename(f) for f in infiles)
+    code = snc.get_code_version([__file__, snc.__file__])
+    key = snc.get_hash([spconfig, days, code])
+    outputs = [trainset_fname, testset_fname]
+    cfile = snc.get_cache_fname(outpath, 'split')
+    cache = snc.load_cache(cfile)
+    if snc.is_cached(cache, 'split', key, []):
+        print("Split is up to date")
+        return
     trainset, testset = fun(infiles, args)
 
     print("Train set:")
@@ -79,5 +84,19 @@ def main(options, args):
     print(testset)
     snc.save_list(testset, testset_fname)
 
+    snc.update_cache(cache, 'split', key, [], outputs)
+    snc.save_cache(cache, cfile)
+
+def main(options, args):
+    config = snc.load_config(options.config)
+    print("Correct config format")
+
+    fconfig = config['format']
+    ext = snc.get_storage(config['dataset'])
+    infiles  = glob.glob("{}/*.{}".format(fconfig['outpath'], ext))
+    print("Input files:")
+    print(infiles)
+    make_split(config, infiles)
+
 if __name__=="__main__":
     main(*parse_options())
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+import optparse
+import os
+import sys
+import copy
+import json
+import time
+import itertools
+import multiprocessing as mp
+import multiprocessing.connection
+import pandas as pd
+import solarnc as snc
+from joblib.externals.loky import get_reusable_executor
+
+phases = ['format', 'extend', 'split', 'fselect', 'train', 'test']
+
+def parse_options():
+    usage_str = "%prog -c json_config_file [-c json_config_file ...] "\
+            "[-g json_grid_file] [-w workdir] [-j num_jobs]"
+    parser = optparse.OptionParser(usage_str)
+    parser.add_option("-c", dest="configs", type="string", action="append",
+            help="path to the json file with the configuration parameters "
+            "of an experiment (can be repeated)")
+    parser.add_option("-g", dest="grid", type="string",
+            help="json file with the values of the parameters to sweep for "
+            "each configuration")
+    parser.add_option("-w", dest="workdir", type="string", default="sweep",
+            help="directory for the configurations and the phase outputs")
+    parser.add_option("-j", dest="npjobs", type="int",
+            help="number of parallel jobs to use", default = mp.cpu_count())
+    parser.add_option("-b", dest="backend", type="choice",
+            choices=["pool", "futures"], default="pool",
+            help="parallel backend: pool (multiprocessing) or futures")
+
+    options, args  = parser.parse_args()
+    if not options.configs: parser.error("missing json config file")
+    return (options, args)
+
+# The grid file maps parameter paths (sections and keys separated by /, as
+# in "fselect/forecasting target/horizon") to lists of values. Every
+# combination of the values gives an experiment.
+def expand_grid(name, config, grid):
+    if grid is None or len(grid) == 0:
+        return [(name, config, {})]
+    keys = sorted(grid.keys())
+    experiments = []
+    for i, values in enumerate(itertools.product(*[grid[k] for k in keys])):
+        c = copy.deepcopy(config)
+        for k, v in zip(keys, values):
+            path = k.split('/')
+            d = c
+            for p in path[:-1]:
+                d = d[p]
+            d[path[-1]] = v
+        experiments.append(("{}-{:03d}".format(name, i), c, \
+                dict(zip(keys, values))))
+    return experiments
+
+def strip_paths(section):
+    section = copy.deepcopy(section)
+    for k in ['outpath', 'rejectpath']:
+        section.pop(k, None)
+    if 'memmap' in section:
+        section['memmap'].pop('path', None)
+    return section
+
+# Each phase of an experiment is a node identified by the configuration
+# sections it reads (without the output paths) and by the nodes of the
+# phases it depends on, so that experiments with the same sections share
+# the node. Extending in place modifies the formatted files, so then the
+# extend section is also part of the format node.
+def get_nodes(config):
+    def section(name):
+        return strip_paths(config[name]) if name in config else None
+
+    inplace = 'extend' in config and 'outpath' not in config['extend']
+    deps = {'format': [], 'extend': ['format'], 'split': ['format'], \
+            'fselect': ['extend' if 'extend' in config else 'format'], \
+            'train': ['fselect', 'split'], 'test': ['train']}
+    sections = {'format': ['dataset', 'format'] + \
+            (['extend'] if inplace else []), 'extend': ['extend'], \
+            'split': ['split'], 'fselect': ['fselect'], 'train': ['train'], \
+            'test': []}
+    nodes = {}
+    for phase in phases:
+        if phase == 'extend' and 'extend' not in config:
+            continue
+        nodes[phase] = snc.get_hash([phase, \
+                [section(s) for s in sections[phase]], \
+                [nodes[d] for d in deps[phase]]])
+    return nodes, deps
+
+# the outputs of each node go to its own directory of the work directory
+def set_paths(config, nodes, workdir):
+    config = copy.deepcopy(config)
+    def path(phase):
+        return "{}/{}-{}".format(workdir, phase, nodes[phase][:12])
+    config['format']['outpath'] = path('format')
+    config['format']['rejectpath'] = "{}/reject".format(path('format'))
+    if 'extend' in config and 'outpath' in config['extend']:
+        config['extend']['outpath'] = path('extend')
+    config['split']['outpath'] = path('split')
+    config['fselect']['outpath'] = path('fselect')
+    config['train']['outpath'] = path('train')
+    if 'memmap' in config['train']:
+        config['train']['memmap']['path'] = "{}/memmap".format(path('train'))
+    return config
+
+def node_worker(phase, cfile, npjobs, backend, logfile):
+    with open(logfile, 'w') as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    module = __import__(phase)
+    module.main(optparse.Values({'config': cfile, 'npjobs': npjobs, \
+            'backend': backend}), [])
+    # multiprocessing children exit without running atexit handlers
+    snc.end_report()
+    get_reusable_executor().shutdown(wait=True)
+    sys.stdout.flush()
+
+# Runs every node once, as soon as the nodes it depends on are done. The
+# ready nodes share the free cores, so a single format node gets all of them
+# and many fselect or train nodes run at the same time with fewer each. The
+# nodes that depend on a failed node are skipped.
+def schedule_nodes(nodes, npjobs, backend, logpath):
+    ctx = mp.get_context('spawn')
+    pending = sorted(nodes.keys(), key=lambda h: phases.index(nodes[h]['phase']))
+    free = npjobs
+    running = {}
+    while len(pending) > 0 or len(running) > 0:
+        for h in list(pending):
+            status = [nodes[d]['status'] for d in nodes[h]['deps']]
+            if any(s in ['failed', 'skipped'] for s in status):
+                nodes[h]['status'] = 'skipped'
+                pending.remove(h)
+        ready = [h for h in pending \
+                if all(nodes[d]['status'] == 'done' for d in nodes[h]['deps'])]
+        for i, h in enumerate(ready):
+            if free == 0 and len(running) > 0:
+                break
+            n = max(1, free // (len(ready) - i))
+            node = nodes[h]
+            logfile = "{}/{}-{}.log".format(logpath, node['phase'], h[:12])
+            p = ctx.Process(target=node_worker, args=(node['phase'], \
+                    node['config'], n, backend, logfile))
+            p.start()
+            print("Running {} {} with {} jobs".format(node['phase'], h[:12], n))
+            running[p.sentinel] = (p, h, n, time.time())
+            free -= n
+            pending.remove(h)
+        if len(running) == 0:
+            continue
+        for sentinel in mp.connection.wait(list(running.keys())):
+            p, h, n, t0 = running.pop(sentinel)
+            p.join()
+            free += n
+            nodes[h]['wall'] = time.time() - t0
+            if p.exitcode != 0:
+                print("Error: {} {} failed".format(nodes[h]['phase'], h[:12]))
+                nodes[h]['status'] = 'failed'
+            else:
+                nodes[h]['status'] = 'done'
+
+# metrics of the test phase of each experiment, in a single file
+def collect_metrics(experiments, nodes, fname):
+    l = []
+    for name, e in experiments.items():
+        h = e['nodes'].get('test')
+        if h is None or nodes[h]['status'] != 'done':
+            continue
+        df = pd.read_csv("{}/metrics.csv".format(nodes[h]['outpath']))
+        df.insert(0, 'experiment', name)
+        l.append(df)
+    if len(l) > 0:
+        pd.concat(l).to_csv(fname, index=False)
+
+def main(options, args):
+    grid = None
+    if options.grid:
+        with open(options.grid, 'r') as f:
+            grid = json.load(f)
+    workdir = os.path.abspath(options.workdir)
+    cpath = "{}/configs".format(workdir)
+    logpath = "{}/logs".format(workdir)
+    for path in [cpath, logpath]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    experiments = {}
+    nodes = {}
+    for fname in options.configs:
+        name = os.path.splitext(os.path.basename(fname))[0]
+        for ename, config, params in expand_grid(name, \
+                snc.load_config(fname), grid):
+            enodes, deps = get_nodes(config)
+            config = set_paths(config, enodes, workdir)
+            cfile = "{}/{}.json".format(cpath, ename)
+            with open(cfile, 'w') as f:
+                json.dump(config, f, indent=1)
+            snc.load_config(cfile)
+            experiments[ename] = {'config': cfile, 'params': params, \
+                    'nodes': enodes}
+            for phase, h in enodes.items():
+                if h in nodes:
+                    nodes[h]['experiments'].append(ename)
+                    continue
+                outpath = config['train']['outpath'] if phase == 'test' \
+                        else "{}/{}-{}".format(workdir, phase, h[:12])
+                nodes[h] = {'phase': phase, 'config': cfile, \
+                        'outpath': outpath, 'deps': [enodes[d] \
+                        for d in deps[phase]], 'experiments': [ename], \
+                        'status': 'pending', 'wall': None}
+    print("Correct config format")
+
+    counts = dict((p, sum(n['phase'] == p for n in nodes.values())) \
+            for p in phases)
+    print("{} experiments, {} phase runs instead of {}".format(\
+            len(experiments), len(nodes), \
+            sum(len(e['nodes']) for e in experiments.values())))
+    for p in phases:
+        if counts[p] > 0:
+            print("\t{}: {}".format(p, counts[p]))
+
+    schedule_nodes(nodes, options.npjobs, options.backend, logpath)
+
+    with open("{}/sweep.json".format(workdir), 'w') as f:
+        json.dump({'experiments': experiments, 'nodes': nodes}, f, indent=1)
+    collect_metrics(experiments, nodes, "{}/metrics.csv".format(workdir))
+    failed = [h[:12] for h, n in nodes.items() if n['status'] != 'done']
+    print("Results in {}".format(workdir))
+    if len(failed) > 0:
+        print("Error: {} phase runs failed or were skipped: {}".format(\
+                len(failed), failed))
+        os._exit(-1)
+
+if __name__ == "__main__":
+    main(*parse_options())
@@ -5,9 +5,6 @@ import solarnc as snc
 import pandas as pd
 import multiprocessing as mp
 import random
-from sklearn.neural_network import MLPRegressor
-from sklearn.model_selection import GridSearchCV
-from sklearn import metrics
 import joblib
 import itertools
 import solarnc as snc
@@ -20,6 +17,9 @@ def parse_options():
             help="path to the json file with the configuration parameters")
     parser.add_option("-j", dest="npjobs", type="int",
             help="number of parallel jobs to use", default = mp.cpu_count())
+    parser.add_option("-b", dest="backend", type="choice",
+            choices=["pool", "futures"], default="pool",
+            help="parallel backend: pool (multiprocessing) or futures")
 
     options, args  = parser.parse_args()
     if not options.config: parser.error("missing json config file")
@@ -35,8 +35,50 @@ def print_model(m):
     elif mtype == 'Linear':
         print(mtype)
 
+def predict_model(mfile, X):
+    sklm = joblib.load(mfile)
+    return np.asarray(sklm.predict(X)).reshape(X.shape[0], -1)
+
+# persistence forecasts the current value of the target variable, which is
+# available as the lag0 feature of that variable
+def get_persistence(X, fcols, tcols):
+    pcols = [" ".join(c.split(' ')[:-1]) + " lag0" for c in tcols]
+    if not all(c in fcols for c in pcols):
+        return None
+    return X[:, [fcols.index(c) for c in pcols]]
+
+# Y is (samples, targets) and Yp is (models, samples, targets). Metrics for
+# all the models and targets are computed at once, and then aggregated by
+# station and by horizon (target columns are "variable station horizon")
+def get_metrics(Y, Yp, P, models, tcols):
+    mse = ((Yp - Y) ** 2).mean(axis=1)
+    mae = np.abs(Yp - Y).mean(axis=1)
+    if P is not None:
+        pmse = ((P - Y) ** 2).mean(axis=0)
+    else:
+        pmse = np.full(len(tcols), np.nan)
+
+    stations = [c.split(' ')[-2] for c in tcols]
+    horizons = [c.split(' ')[-1] for c in tcols]
+    groups = [('all', 'all', list(range(len(tcols))))]
+    for gname, keys in [('station', stations), ('horizon', horizons)]:
+        for k in sorted(set(keys)):
+            groups.append((gname, k, [i for i, x in enumerate(keys) if x == k]))
+
+    rows = []
+    for gname, k, idx in groups:
+        rmse = np.sqrt(mse[:, idx].mean(axis=1))
+        gmae = mae[:, idx].mean(axis=1)
+        prmse = np.sqrt(pmse[idx].mean())
+        for i, m in enumerate(models):
+            rows.append([m, gname, k, rmse[i], gmae[i], prmse, \
+                    1 - rmse[i] / prmse])
+    return pd.DataFrame(rows, columns=['model', 'group', 'key', 'rmse', \
+            'mae', 'persistence rmse', 'skill'])
+
 def main(options, args):
     config = snc.load_config(options.config)
+    snc.jobs_backend = options.backend
     print("Correct config format")
 
     spconfig = config['split']
@@ -45,35 +87,57 @@ def main(options, args):
     print("Testset from {} is:".format(testset_fname))
     print(testset)
 
+    ext = snc.get_storage(config['dataset'])
     fsconfig = config['fselect']
-    ffiles  = ["{}/{}_features.csv".format(fsconfig['outpath'], f)\
+    ffiles  = ["{}/{}_features.{}".format(fsconfig['outpath'], f, ext)\
             .replace("//","/") for f in testset]
     print("Features files:")
     print(ffiles)
 
-    tfiles  = ["{}/{}_targets.csv".format(fsconfig['outpath'], f)\
+    tfiles  = ["{}/{}_targets.{}".format(fsconfig['outpath'], f, ext)\
             .replace("//","/") for f in testset]
     print("Input targets files:")
     print(tfiles)
 
-    tzone = config['dataset']['timezone']
-    X, Y = snc.get_feature_target_data(ffiles, tfiles, tzone)
-
     tconfig = config['train']
     mpath = tconfig['outpath']
-    #if not os.path.exists(outpath):
-    #    os.makedirs(outpath)
-
-    for m in tconfig['models']:
-        mfile = "{}/{}.joblib".format(mpath,m['filename'])
-        sklm = joblib.load(mfile)
-        Yp = sklm.predict(np.array(X))
-        snc.save_csv(pd.DataFrame(Yp, index=Y.index, columns = Y.columns), "{}/{}_Yp.csv"\
-                .format(mpath,m['filename']))
-        snc.save_csv(Y, "{}/{}_Y.csv"\
-                .format(mpath,m['filename']))
-        rmse = np.sqrt(((np.array(Y)-Yp)**2).mean().mean())
-        print("RMSE for model {} is: {}".format(mfile, rmse))
+    snc.start_report(mpath, 'test')
+
+    tzone = config['dataset']['timezone']
+    if 'memmap' in tconfig:
+        mmconfig = tconfig['memmap']
+        dtype = mmconfig['dtype'] if 'dtype' in mmconfig else 'float64'
+        path = "{}/test".format(mmconfig['path'])
+        print("Memory mapped X and Y in {}".format(path))
+        X, Y, index, fcols, tcols = snc.get_feature_target_memmap(ffiles, \
+                tfiles, tzone, path, dtype)
+    else:
+        X, Y = snc.get_feature_target_data(ffiles, tfiles, tzone)
+        index, fcols, tcols = Y.index, list(X.columns), list(Y.columns)
+    X = np.ascontiguousarray(X, dtype=float)
+    Y = np.ascontiguousarray(Y, dtype=float)
+    snc.save_csv(pd.DataFrame(Y, index=index, columns=tcols), \
+            "{}/Y.csv".format(mpath))
+
+    models = [m['filename'] for m in tconfig['models']]
+    mfiles = ["{}/{}.joblib".format(mpath, m) for m in models]
+    Yp = np.empty((len(models),) + Y.shape)
+    def done(i, result):
+        Yp[i] = result
+    snc.runjobs(predict_model, [(f,) for f in mfiles], options.npjobs, \
+            (X,), done)
+
+    for m, yp in zip(models, Yp):
+        snc.save_csv(pd.DataFrame(yp, index=index, columns=tcols), \
+                "{}/{}_Yp.csv".format(mpath, m))
+
+    P = get_persistence(X, fcols, tcols)
+    metrics = get_metrics(Y, Yp, P, models, tcols)
+    metrics.to_csv("{}/metrics.csv".format(mpath), index=False)
+    for m, mfile in zip(models, mfiles):
+        rmse = metrics[(metrics.model == m) & (metrics.group == 'all')].rmse
+        print("RMSE for model {} is: {}".format(mfile, rmse.iloc[0]))
+    print(metrics.to_string(index=False))
 
 if __name__=="__main__":
     main(*parse_options())
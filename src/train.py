@@ -3,14 +3,25 @@ import optparse
 import os
 import solarnc as snc
 import pandas as pd
+import numpy as np
 import multiprocessing as mp
+import multiprocessing.connection
 import random
 from sklearn.neural_network import MLPRegressor
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import GridSearchCV, KFold, GroupKFold
+from sklearn.model_selection import ParameterGrid
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingGridSearchCV
 from sklearn import linear_model
 from sklearn import metrics
+from sklearn.multioutput import MultiOutputRegressor
+from sklearn.pipeline import make_pipeline
+from sklearn.base import clone
+from sklearn.preprocessing import StandardScaler
 import joblib
+from joblib.externals.loky import get_reusable_executor
 import itertools
+import time
 import solarnc as snc
 
 def parse_options():
@@ -25,8 +36,14 @@ def parse_options():
     if not options.config: parser.error("missing json config file")
     return (options, args)
 
+# times of the last search, added to the model record of the run report
+search_times = {}
+
 def log_gridsearch(gs, logf):
-    logf.write("GridSearchCV results:\n")
+    search_times['refit_time'] = gs.refit_time_
+    search_times['mean_fit_time'] = float(gs.cv_results_['mean_fit_time']\
+            .mean())
+    logf.write("{} results:\n".format(type(gs).__name__))
     results = pd.DataFrame(gs.cv_results_)
     logf.write(str(results))
     logf.write("\n")
@@ -37,28 +54,146 @@ def log_gridsearch(gs, logf):
     logf.write("number of splits: {}\n".format(gs.n_splits_))
     logf.write("refit time: {}\n".format(gs.refit_time_))
 
-def train_MLPRegressor(m, X, Y, logfile, npjobs):
+# Path search for the linear models: each fold is decomposed only once and
+# the validation error is computed for all the alpha values from it. Scores
+# are the negative mean squared error, as in the GridSearchCV searches.
+def get_folds(cv, X):
+    if isinstance(cv, list):
+        return cv
+    return list(KFold(n_splits=int(cv)).split(X))
+
+def center_fold(X, Y, train, test):
+    Xt = np.asarray(X[train], dtype=float)
+    Yt = np.asarray(Y[train], dtype=float).reshape(len(train), -1)
+    xmean = Xt.mean(axis=0)
+    ymean = Yt.mean(axis=0)
+    Xv = np.asarray(X[test], dtype=float) - xmean
+    Yv = np.asarray(Y[test], dtype=float).reshape(len(test), -1) - ymean
+    return Xt - xmean, Yt - ymean, Xv, Yv
+
+# ridge coefficients for every alpha from one eigendecomposition of the
+# centered Gram matrix of the fold
+def ridge_path_scores(X, Y, alphas, folds):
+    scores = np.empty((len(alphas), len(folds)))
+    for j, (train, test) in enumerate(folds):
+        Xt, Yt, Xv, Yv = center_fold(X, Y, train, test)
+        evals, Q = np.linalg.eigh(Xt.T @ Xt)
+        QXY = Q.T @ (Xt.T @ Yt)
+        XvQ = Xv @ Q
+        for i, a in enumerate(alphas):
+            Yp = XvQ @ (QXY / (evals + a)[:, None])
+            scores[i, j] = -((Yp - Yv) ** 2).mean()
+    return scores
+
+# the lasso path computed by LARS is piecewise linear in alpha, so the
+# coefficients for every alpha are interpolated from the path of the fold
+def lars_path_scores(X, Y, alphas, folds):
+    scores = np.zeros((len(alphas), len(folds)))
+    for j, (train, test) in enumerate(folds):
+        Xt, Yt, Xv, Yv = center_fold(X, Y, train, test)
+        gram = Xt.T @ Xt
+        for k in range(Yt.shape[1]):
+            apath, active, coefs = linear_model.lars_path(Xt, Yt[:, k], \
+                    Gram=gram, Xy=Xt.T @ Yt[:, k], method='lasso', \
+                    alpha_min=min(alphas))
+            for i, a in enumerate(alphas):
+                coef = np.array([np.interp(a, apath[::-1], c[::-1]) \
+                        for c in coefs])
+                err = ((Xv @ coef - Yv[:, k]) ** 2).mean()
+                scores[i, j] -= err / Yt.shape[1]
+    return scores
+
+def path_search(cv, X, Y, alphas, scorefun, estimator, logf):
+    folds = get_folds(cv, X)
+    t0 = time.time()
+    scores = scorefun(X, Y, alphas, folds)
+    search_time = time.time() - t0
+    mean = scores.mean(axis=1)
+    best = int(np.argmax(mean))
+
+    t0 = time.time()
+    reg = estimator.set_params(alpha=alphas[best]).fit(X, Y)
+    refit_time = time.time() - t0
+    search_times['search_time'] = search_time
+    search_times['refit_time'] = refit_time
+
+    results = pd.DataFrame(scores, columns=["split{}_test_score".format(j) \
+            for j in range(len(folds))])
+    results.insert(0, 'param_alpha', alphas)
+    results['mean_test_score'] = mean
+    results['std_test_score'] = scores.std(axis=1)
+    logf.write("Path search results:\n")
+    logf.write(str(results))
+    logf.write("\n")
+    logf.write("Best score: {}\n".format(mean[best]))
+    logf.write("Best params: {}\n".format(str({'alpha': alphas[best]})))
+    logf.write("Best index: {}\n".format(best))
+    logf.write("number of splits: {}\n".format(len(folds)))
+    logf.write("search time: {}\n".format(search_time))
+    logf.write("refit time: {}\n".format(refit_time))
+    return reg
+
+# Successive halving: every combination is first fitted with a small amount
+# of the resource (rows of the train folds or solver iterations) and only the
+# best 1/factor of them are fitted again with factor times more, until the
+# last round uses all of it. With iterations, the rounds are those needed to
+# keep a single combination and the first one is rounded up, so the last
+# round (and the refit of the best combination) uses max_iter, or the next
+# multiple of factor**(rounds-1) if it is not one. The adam and sgd solvers
+# also stop early when the score on a validation split of the rows stops
+# improving.
+def get_halving_search(m, mlr, pgrid, npjobs, cv):
+    factor = m['halving factor'] if 'halving factor' in m else 3
+    resource = m['halving resource'] if 'halving resource' in m else 'rows'
+    if resource == 'rows':
+        return HalvingGridSearchCV(mlr, param_grid = pgrid, factor=factor, \
+                resource='n_samples', scoring='neg_mean_squared_error', \
+                n_jobs=npjobs, cv = cv)
+    rounds = 1 + int(np.floor(np.log(len(ParameterGrid(pgrid))) / \
+            np.log(factor)))
+    scale = factor ** (rounds - 1)
+    min_resources = int(np.ceil(mlr.max_iter / scale))
+    return HalvingGridSearchCV(mlr, param_grid = pgrid, factor=factor, \
+            resource='max_iter', min_resources=min_resources, \
+            max_resources=min_resources * int(np.ceil(scale)), \
+            scoring='neg_mean_squared_error', n_jobs=npjobs, cv = cv)
+
+def log_halvingsearch(gs, logf):
+    logf.write("Halving iterations: {}\n".format(gs.n_iterations_))
+    logf.write("Candidates per iteration: {}\n".format(gs.n_candidates_))
+    logf.write("Resources per iteration: {}\n".format(gs.n_resources_))
+    trace = pd.DataFrame(gs.cv_results_)[['iter', 'n_resources', \
+            'param_hidden_layer_sizes', 'param_alpha', 'mean_test_score']]
+    logf.write("Search trace:\n")
+    logf.write(trace.to_string())
+    logf.write("\n")
+
+def train_MLPRegressor(m, X, Y, logfile, npjobs, cv):
     alphas = m['alpha']
-    hlnum = m['hidden layers count']
-    hlsizes = tuple(m['hidden layers sizes'])
-    hlayers = []
-    for n in hlnum:
-        hlayers += [x for x in itertools.product(hlsizes,repeat=n)]
+    hlayers = get_hidden_layers(m)
     pgrid={'alpha': alphas, 'hidden_layer_sizes': hlayers}
-    mlr = MLPRegressor(solver='lbfgs')
+    solver = m['solver'] if 'solver' in m else 'lbfgs'
+    search = m['search'] if 'search' in m else 'grid'
 
-    gs = GridSearchCV(mlr, param_grid = pgrid, \
-            scoring='neg_mean_squared_error', n_jobs=npjobs, cv = m['cv'])
+    if search == 'halving':
+        mlr = MLPRegressor(solver=solver, early_stopping=solver != 'lbfgs')
+        gs = get_halving_search(m, mlr, pgrid, npjobs, cv)
+    else:
+        mlr = MLPRegressor(solver=solver)
+        gs = GridSearchCV(mlr, param_grid = pgrid, \
+                scoring='neg_mean_squared_error', n_jobs=npjobs, cv = cv)
     gs.fit(X,Y)
 
     with open(logfile, "w") as logf:
         logf.write("Searched for hidden layers: {}\n".format(hlayers))
         logf.write("Searched for alpha values: {}\n".format(alphas))
         log_gridsearch(gs, logf)
+        if search == 'halving':
+            log_halvingsearch(gs, logf)
 
     return gs.best_estimator_
 
-def train_Linear(m, X, Y, logfile, npjobs):
+def train_Linear(m, X, Y, logfile, npjobs, cv):
     reg = linear_model.LinearRegression()
     reg.fit(X,Y)
     with open(logfile, "w") as logf:
@@ -66,12 +201,19 @@ def train_Linear(m, X, Y, logfile, npjobs):
         logf.write("Coefficients: {}\n".format(reg.coef_))
     return reg
 
-def train_Ridge(m, X, Y, logfile, npjobs):
+def train_Ridge(m, X, Y, logfile, npjobs, cv):
     alphas = m['alpha']
+    if 'search' in m and m['search'] == 'path':
+        with open(logfile, "w") as logf:
+            logf.write("Searched for alpha values: {}\n".format(alphas))
+            reg = path_search(cv, X, Y, alphas, ridge_path_scores, \
+                    linear_model.Ridge(), logf)
+        return reg
+
     pgrid={'alpha': alphas}
     reg = linear_model.Ridge()
     gs = GridSearchCV(reg, param_grid = pgrid, \
-            scoring='neg_mean_squared_error', n_jobs=npjobs, cv = m['cv'])
+            scoring='neg_mean_squared_error', n_jobs=npjobs, cv = cv)
     gs.fit(X,Y)
 
     with open(logfile, "w") as logf:
@@ -80,43 +222,70 @@ def train_Ridge(m, X, Y, logfile, npjobs):
 
     return gs.best_estimator_
 
-def train_Lasso(m, X, Y, logfile, npjobs):
+def train_Lasso(m, X, Y, logfile, npjobs, cv):
     alphas = m['alpha']
     if Y.shape[1] == 1:
-        reg = linear_model.LassoCV(cv=m['cv'], random_state=0, \
-                n_jobs=npjobs).fit(X, Y)
+        reg = linear_model.LassoCV(cv=cv, alphas=alphas, \
+                random_state=0, n_jobs=npjobs).fit(X, np.ravel(Y))
     else:
-        reg = linear_model.MultiTaskLassoCV(cv=m['cv'], random_state=0, \
-                n_jobs=npjobs).fit(X, Y)
+        reg = linear_model.MultiTaskLassoCV(cv=cv, alphas=alphas, \
+                random_state=0, n_jobs=npjobs).fit(X, Y)
 
     with open(logfile, "w") as logf:
         logf.write("Searched for alpha values: {}\n".format(alphas))
-        logf.write("Parameters: {}".format(reg.get_params()))
+        logf.write("Parameters: {}\n".format(reg.get_params()))
+        logf.write("Best alpha: {}\n".format(reg.alpha_))
+        logf.write("Mean squared error path: {}\n".format(reg.mse_path_))
 
     return reg
 
-def train_ElasticNet(m, X, Y, logfile, npjobs):
+def train_ElasticNet(m, X, Y, logfile, npjobs, cv):
     alphas = m['alpha']
     l1_ratios = m['l1_ratio']
     if Y.shape[1] == 1:
-        reg = linear_model.ElasticNetCV(cv=m['cv'], l1_ratio=l1_ratios, \
-                n_jobs=npjobs).fit(X, Y)
+        reg = linear_model.ElasticNetCV(cv=cv, l1_ratio=l1_ratios, \
+                alphas=alphas, n_jobs=npjobs).fit(X, np.ravel(Y))
     else:
-        reg = linear_model.MultiTaskElasticNetCV(cv=m['cv'], \
-                l1_ratio=l1_ratios, n_jobs=npjobs).fit(X, Y)
+        reg = linear_model.MultiTaskElasticNetCV(cv=cv, \
+                l1_ratio=l1_ratios, alphas=alphas, n_jobs=npjobs).fit(X, Y)
 
     with open(logfile, "w") as logf:
         logf.write("Searched for alpha values: {}\n".format(alphas))
-        logf.write("Parameters: {}".format(reg.get_params()))
+        logf.write("Parameters: {}\n".format(reg.get_params()))
+        logf.write("Best alpha: {}\n".format(reg.alpha_))
+        logf.write("Best l1_ratio: {}\n".format(reg.l1_ratio_))
+        logf.write("Mean squared error path: {}\n".format(reg.mse_path_))
 
     return reg
 
-def train_LARS(m, X, Y, logfile, npjobs):
+def train_LARS(m, X, Y, logfile, npjobs, cv):
     alphas = m['alpha']
+    if 'search' in m and m['search'] == 'path':
+        with open(logfile, "w") as logf:
+            logf.write("Searched for alpha values: {}\n".format(alphas))
+            reg = path_search(cv, X, Y, alphas, lars_path_scores, \
+                    linear_model.LassoLars(), logf)
+        return reg
+
     pgrid={'alpha': alphas}
     reg = linear_model.LassoLars()
     gs = GridSearchCV(reg, param_grid = pgrid, \
-            scoring='neg_mean_squared_error', n_jobs=npjobs, cv = m['cv'])
+            scoring='neg_mean_squared_error', n_jobs=npjobs, cv = cv)
+    gs.fit(X,Y)
+
+    with open(logfile, "w") as logf:
+        logf.write("Searched for alpha values: {}\n".format(alphas))
+        log_gridsearch(gs, logf)
+
+    return gs.best_estimator_
+
+def train_SGD(m, X, Y, logfile, npjobs, cv):
+    alphas = m['alpha']
+    pgrid={'multioutputregressor__estimator__alpha': alphas}
+    reg = make_pipeline(StandardScaler(), \
+            MultiOutputRegressor(linear_model.SGDRegressor(random_state=0)))
+    gs = GridSearchCV(reg, param_grid = pgrid, \
+            scoring='neg_mean_squared_error', n_jobs=npjobs, cv = cv)
     gs.fit(X,Y)
 
     with open(logfile, "w") as logf:
@@ -125,7 +294,7 @@ def train_LARS(m, X, Y, logfile, npjobs):
 
     return gs.best_estimator_
 
-def train_model(m, X, Y, outpath, skip, npjobs):
+def train_model(m, X, Y, outpath, skip, npjobs, folds=None):
     ofile = "{}/{}.joblib".format(outpath, m['filename'])
     if skip and os.path.exists(ofile):
         return
@@ -136,9 +305,283 @@ def train_model(m, X, Y, outpath, skip, npjobs):
     if not callable(tfun):
         print("Model {} is not supported".format(mtype))
         return
-    mod = tfun(m, X, Y, logfile, npjobs)
+    cv = get_model_cv(m, folds)
+    search_times.clear()
+    wall, cpu = time.time(), time.process_time()
+    mod = tfun(m, X, Y, logfile, npjobs, cv)
+    record = {'type': 'model', 'model': m['filename'], 'model type': mtype, \
+            'rows': len(X), 'npjobs': npjobs, 'fit_time': time.time() - wall, \
+            'cpu': time.process_time() - cpu, 'pid': os.getpid()}
+    record.update(search_times)
+    snc.write_report(record)
     joblib.dump(mod, ofile)
 
+# The cross validation folds are computed once in main and shared by all the
+# models. With "cv split" set to "days" every fold holds whole day files
+# (GroupKFold) and with "blocks" every fold is a block of consecutive days,
+# so that samples of the same day are never used both to fit and to score.
+# The default ("rows") keeps the KFold over the concatenated rows.
+def get_cv_folds(models, split, index, ffiles):
+    if split == 'rows':
+        return None
+    nrows = np.array([snc.count_rows(f) for f in ffiles])
+    ndays = np.count_nonzero(nrows)
+    days = np.repeat(np.arange(len(nrows)), nrows)
+    # days ordered by their first sample
+    starts = index[(np.cumsum(nrows) - nrows)[nrows > 0]]
+    order = np.flatnonzero(nrows > 0)[np.argsort(starts, kind='stable')]
+
+    folds = {}
+    for cv in sorted(set(int(m['cv']) for m in models if 'cv' in m)):
+        if cv > ndays:
+            print("Error: cv {} is larger than the number of days {}"\
+                    .format(cv, ndays))
+            raise ValueError
+        if split == 'days':
+            splits = GroupKFold(n_splits=cv).split(days, groups=days)
+        else:
+            dayfold = np.empty(len(nrows), dtype=int)
+            for k, block in enumerate(np.array_split(order, cv)):
+                dayfold[block] = k
+            rowfold = dayfold[days]
+            splits = [(np.flatnonzero(rowfold != k), \
+                    np.flatnonzero(rowfold == k)) for k in range(cv)]
+        folds[cv] = list(splits)
+    return folds
+
+def get_model_cv(m, folds):
+    if 'cv' not in m:
+        return None
+    if folds is None:
+        return m['cv']
+    return folds[int(m['cv'])]
+
+# Incremental (out of core) training. The day files are read one at a time
+# and their rows are grouped in shuffled batches of a fixed size, so memory
+# does not depend on the size of the train set. Every parameter combination
+# of every model is updated with partial_fit from the same batches. The
+# features are standardized with running statistics accumulated during the
+# first epoch. One of every cv days is held out to choose the best
+# combination of each model, which is then trained again on all the days.
+def get_incremental_grid(m):
+    mtype = m['model type']
+    grid = []
+    if mtype == 'MLPRegressor':
+        solver = m['solver'] if 'solver' in m else 'adam'
+        if solver not in ['adam', 'sgd']:
+            print("Error: MLPRegressor {} needs solver adam or sgd to be "\
+                    "trained incrementally".format(m['filename']))
+            raise ValueError
+        for h in get_hidden_layers(m):
+            for a in m['alpha']:
+                grid.append(({'alpha': a, 'hidden_layer_sizes': h}, \
+                        MLPRegressor(solver=solver, alpha=a, \
+                        hidden_layer_sizes=h, random_state=0)))
+    elif mtype == 'SGD':
+        for a in m['alpha']:
+            grid.append(({'alpha': a}, MultiOutputRegressor(\
+                    linear_model.SGDRegressor(alpha=a, random_state=0))))
+    else:
+        print("Error: model {} can not be trained incrementally".format(mtype))
+        raise ValueError
+    return grid
+
+def get_batches(ffiles, tfiles, tzone, size, seed):
+    rng = np.random.default_rng(seed)
+    X, Y, D = [], [], []
+    nrows = 0
+    for day, (ff, tf) in enumerate(zip(ffiles, tfiles)):
+        X.append(snc.read_data(ff, tzone).to_numpy(dtype=float))
+        Y.append(snc.read_data(tf, tzone).to_numpy(dtype=float))
+        D.append(np.full(len(X[-1]), day))
+        nrows += len(X[-1])
+        last = day == len(ffiles) - 1
+        if nrows < size and not last:
+            continue
+        X, Y, D = np.concatenate(X), np.concatenate(Y), np.concatenate(D)
+        perm = rng.permutation(nrows)
+        n = nrows if last else nrows - nrows % size
+        for i in range(0, n, size):
+            b = perm[i:min(i + size, n)]
+            yield X[b], Y[b], D[b]
+        rest = perm[n:]
+        X, Y, D = [X[rest]], [Y[rest]], [D[rest]]
+        nrows = len(rest)
+
+def train_incremental(models, ffiles, tfiles, tzone, outpath, iconfig, done):
+    size = int(iconfig['batch size'])
+    epochs = int(iconfig['epochs']) if 'epochs' in iconfig else 1
+    grids = [get_incremental_grid(m) for m in models]
+    holdout = [int(m['cv']) for m in models]
+    for m, cv in zip(models, holdout):
+        if cv < 2:
+            print("Error: {} needs cv of at least 2 to hold out days in the "\
+                    "incremental training".format(m['filename']))
+            raise ValueError
+        if cv > len(ffiles):
+            print("Error: cv {} is larger than the number of days {}"\
+                    .format(cv, len(ffiles)))
+            raise ValueError
+    scaler = StandardScaler()
+
+    t0 = time.time()
+    nbatches = 0
+    for epoch in range(epochs):
+        for X, Y, D in get_batches(ffiles, tfiles, tzone, size, epoch):
+            if epoch == 0:
+                scaler.partial_fit(X)
+            X = scaler.transform(X)
+            for grid, cv in zip(grids, holdout):
+                fit = D % cv != cv - 1
+                if not fit.any():
+                    continue
+                for params, est in grid:
+                    est.partial_fit(X[fit], Y[fit])
+            nbatches += 1
+        print("Epoch {} done".format(epoch + 1))
+    fit_time = time.time() - t0
+
+    # validation error on the held out days
+    sse = [np.zeros(len(grid)) for grid in grids]
+    count = np.zeros(len(models))
+    for X, Y, D in get_batches(ffiles, tfiles, tzone, size, 0):
+        X = scaler.transform(X)
+        for i, (grid, cv) in enumerate(zip(grids, holdout)):
+            val = D % cv == cv - 1
+            if not val.any():
+                continue
+            count[i] += val.sum() * Y.shape[1]
+            for j, (params, est) in enumerate(grid):
+                sse[i][j] += ((est.predict(X[val]).reshape(Y[val].shape) \
+                        - Y[val]) ** 2).sum()
+
+    results, best = [], []
+    for i in range(len(models)):
+        res = pd.DataFrame([p for p, est in grids[i]])
+        res['mean_test_score'] = -sse[i] / max(count[i], 1)
+        results.append(res)
+        best.append(int(np.argmax(res['mean_test_score'])))
+
+    # the best combination of each model is trained again on all the days
+    t0 = time.time()
+    refits = [clone(grids[i][b][1]) for i, b in enumerate(best)]
+    for epoch in range(epochs):
+        for X, Y, D in get_batches(ffiles, tfiles, tzone, size, epoch):
+            X = scaler.transform(X)
+            for est in refits:
+                est.partial_fit(X, Y)
+    refit_time = time.time() - t0
+
+    for i, m in enumerate(models):
+        mod = make_pipeline(scaler, refits[i])
+        logfile = "{}/{}.log".format(outpath, m['filename'])
+        with open(logfile, "w") as logf:
+            logf.write("Incremental training results:\n")
+            logf.write(str(results[i]))
+            logf.write("\n")
+            logf.write("Best score: {}\n".format(results[i]['mean_test_score']\
+                    [best[i]]))
+            logf.write("Best params: {}\n".format(str(grids[i][best[i]][0])))
+            logf.write("Best index: {}\n".format(best[i]))
+            logf.write("Held out days: 1 of every {}\n".format(holdout[i]))
+            logf.write("Batch size: {}\n".format(size))
+            logf.write("Epochs: {}\n".format(epochs))
+            logf.write("Batches: {}\n".format(nbatches))
+            logf.write("fit time: {}\n".format(fit_time))
+            logf.write("refit time: {}\n".format(refit_time))
+        snc.write_report({'type': 'model', 'model': m['filename'], \
+                'model type': m['model type'], 'batches': nbatches, \
+                'epochs': epochs, 'fit_time': fit_time, \
+                'refit_time': refit_time, 'pid': os.getpid()})
+        joblib.dump(mod, "{}/{}.joblib".format(outpath, m['filename']))
+        print("Done: {}".format(m['filename']))
+        done(m)
+
+def get_hidden_layers(m):
+    hlayers = []
+    for n in m['hidden layers count']:
+        hlayers += [x for x in itertools.product(m['hidden layers sizes'], \
+                repeat=n)]
+    return hlayers
+
+# Estimated cost of a model entry (relative to a single linear fit) and the
+# number of independent fits it can run in parallel
+def get_model_cost(m):
+    mtype = m['model type']
+    if mtype == 'Linear':
+        return 1, 1
+    cv = int(m['cv'])
+    nfits = cv * len(m['alpha'])
+    if mtype == 'MLPRegressor':
+        hlayers = get_hidden_layers(m)
+        nfits *= len(hlayers)
+        size = sum(np.prod(h) for h in hlayers) / len(hlayers)
+        if 'search' in m and m['search'] == 'halving':
+            # each round costs about as much as cv full fits
+            factor = m['halving factor'] if 'halving factor' in m else 3
+            rounds = np.ceil(np.log(nfits / cv) / np.log(factor)) + 1
+            return cv * rounds * size, nfits
+        return nfits * size, nfits
+    elif mtype == 'ElasticNet':
+        nfits *= len(m['l1_ratio'])
+    return nfits, nfits
+
+# the cores are shared among the models proportionally to their cost, each
+# model getting at least one core and no more than the fits it can run
+def get_model_cores(models, npjobs):
+    costs = [get_model_cost(m) for m in models]
+    total = sum(c for c, n in costs)
+    return [max(1, min(nfits, npjobs, round(npjobs * c / total))) \
+            for c, nfits in costs]
+
+def train_worker(m, xfname, yfname, outpath, skip, npjobs, folds, report):
+    snc.report_fname = report
+    X = np.load(xfname, mmap_mode='r')
+    Y = np.load(yfname, mmap_mode='r')
+    train_model(m, X, Y, outpath, skip, npjobs, folds)
+    # multiprocessing children exit without running atexit handlers, so the
+    # loky workers used by the searches have to be stopped here
+    get_reusable_executor().shutdown(wait=True)
+
+# Runs several models at the same time, each one in its own process with the
+# number of cores given by get_model_cores, as long as the total does not
+# exceed npjobs. X and Y are read by all the processes from the same memory
+# mapped .npy files and use the same cv folds. done(m) is called when model m
+# has been trained.
+def schedule_models(models, xfname, yfname, outpath, skip, npjobs, folds, \
+        done):
+    # forked children may deadlock on locks held by threads of the parent
+    # (BLAS, arrow), so workers are started with spawn
+    ctx = mp.get_context('spawn')
+    cores = get_model_cores(models, npjobs)
+    queue = sorted(zip(models, cores), key=lambda x: -get_model_cost(x[0])[0])
+    free = npjobs
+    running = {}
+    failed = []
+    while len(queue) > 0 or len(running) > 0:
+        for m, n in list(queue):
+            if n <= free or len(running) == 0:
+                p = ctx.Process(target=train_worker, \
+                        args=(m, xfname, yfname, outpath, skip, n, folds, \
+                        snc.report_fname))
+                p.start()
+                print("Training {} with {} jobs".format(m['filename'], n))
+                running[p.sentinel] = (p, m, n)
+                free -= n
+                queue.remove((m, n))
+        for sentinel in mp.connection.wait(list(running.keys())):
+            p, m, n = running.pop(sentinel)
+            p.join()
+            free += n
+            if p.exitcode != 0:
+                print("Error: training of {} failed".format(m['filename']))
+                failed.append(m['filename'])
+            else:
+                print("Done: {}".format(m['filename']))
+                done(m)
+    if len(failed) > 0:
+        raise RuntimeError("{} models failed: {}".format(len(failed), failed))
+
 def main(options, args):
     config = snc.load_config(options.config)
     print("Correct config format")
@@ -149,13 +592,14 @@ def main(options, args):
     print("Trainset from {} is:".format(trainset_fname))
     print(trainset)
 
+    ext = snc.get_storage(config['dataset'])
     fsconfig = config['fselect']
-    ffiles  = ["{}/{}_features.csv".format(fsconfig['outpath'], f)\
+    ffiles  = ["{}/{}_features.{}".format(fsconfig['outpath'], f, ext)\
             .replace("//","/") for f in trainset]
     print("Features files:")
     print(ffiles)
 
-    tfiles  = ["{}/{}_targets.csv".format(fsconfig['outpath'], f)\
+    tfiles  = ["{}/{}_targets.{}".format(fsconfig['outpath'], f, ext)\
             .replace("//","/") for f in trainset]
     print("Input targets files:")
     print(tfiles)
@@ -165,19 +609,80 @@ def main(options, args):
     if not os.path.exists(outpath):
         os.makedirs(outpath)
     print("Models stored in {}".format(outpath))
+    snc.start_report(outpath, 'train')
 
     models = tconfig['models']
     for m in models:
         print(m)
     skip = tconfig['skip existing']
     if skip:
-        print("Skipping existing models")
+        print("Skipping up to date models")
+    split = tconfig['cv split'] if 'cv split' in tconfig else 'rows'
+    print("Cross validation folds split by {}".format(split))
+
+    code = snc.get_code_version([__file__, snc.__file__])
+    inputs = [trainset_fname] + ffiles + tfiles
+    cfile = snc.get_cache_fname(outpath, 'train')
+    cache = snc.load_cache(cfile)
+    incremental = tconfig['incremental'] if 'incremental' in tconfig else None
+    # models trained from float32 memory mapped data are not reused for
+    # float64 data and the other way around
+    dtype = None
+    if 'memmap' in tconfig:
+        mmconfig = tconfig['memmap']
+        dtype = mmconfig['dtype'] if 'dtype' in mmconfig else 'float64'
+    keys = dict((m['filename'], snc.get_hash([m, split, incremental, dtype, \
+            code])) for m in models)
+    # existing models are only skipped if they are up to date
+    if skip:
+        models = [m for m in models if not snc.is_cached(cache, \
+                m['filename'], keys[m['filename']], inputs)]
+    if len(models) == 0:
+        print("All models are up to date")
+        return
+
+    def done(m):
+        outputs = ["{}/{}.{}".format(outpath, m['filename'], e) \
+                for e in ['joblib', 'log']]
+        snc.update_cache(cache, m['filename'], keys[m['filename']], inputs, \
+                outputs)
+        snc.save_cache(cache, cfile)
 
     tzone = config['dataset']['timezone']
-    X, Y = snc.get_feature_target_data(ffiles, tfiles, tzone)
+    if 'incremental' in tconfig:
+        print("Training incrementally in batches of {} rows".format(\
+                tconfig['incremental']['batch size']))
+        train_incremental(models, ffiles, tfiles, tzone, outpath, \
+                tconfig['incremental'], done)
+        return
 
-    for m in models:
-        train_model(m, X, Y, outpath, skip, options.npjobs)
+    if 'memmap' in tconfig:
+        mmconfig = tconfig['memmap']
+        dtype = mmconfig['dtype'] if 'dtype' in mmconfig else 'float64'
+        print("Memory mapped X and Y in {}".format(mmconfig['path']))
+        snc.get_feature_target_memmap(ffiles, tfiles, tzone, \
+                mmconfig['path'], dtype)
+        xfname = "{}/X.npy".format(mmconfig['path'])
+        yfname = "{}/Y.npy".format(mmconfig['path'])
+        index = np.load("{}/index.npy".format(mmconfig['path']))
+        tmpfiles = []
+    else:
+        X, Y = snc.get_feature_target_data(ffiles, tfiles, tzone)
+        xfname = "{}/.X.npy".format(outpath)
+        yfname = "{}/.Y.npy".format(outpath)
+        np.save(xfname, X.to_numpy(dtype=float))
+        np.save(yfname, Y.to_numpy(dtype=float))
+        index = X.index.values.astype('datetime64[ns]').view('int64')
+        tmpfiles = [xfname, yfname]
+        del X, Y
+    folds = get_cv_folds(models, split, index, ffiles)
+
+    try:
+        schedule_models(models, xfname, yfname, outpath, False, \
+                options.npjobs, folds, done)
+    finally:
+        for f in tmpfiles:
+            os.remove(f)
 
 if __name__=="__main__":
     main(*parse_options())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tools are plain scripts in src/ that import each other as modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
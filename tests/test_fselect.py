@@ -0,0 +1,19 @@
+import pytest
+import fselect as fs
+
+def target(horizon, interval):
+    return {'forecasting target': {'variable': 'GHI', 'stations': ['AP1'], \
+            'horizon': horizon, 'interval': interval}}
+
+def test_get_horizons_broadcasts_single_interval():
+    assert fs.get_horizons(target(['10min', '20min'], '+5min')) == \
+            [('10min', '+5min'), ('20min', '+5min')]
+
+@pytest.mark.parametrize('horizon,interval', [
+    ('10min', ['+5min', '+10min']),
+    (['10min', '20min'], ['+5min']),
+    (['10min'], ['+5min', '+10min']),
+])
+def test_get_horizons_rejects_mismatched_intervals(horizon, interval):
+    with pytest.raises(ValueError):
+        fs.get_horizons(target(horizon, interval))
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+import solarnc as snc
+
+def timestamps(index):
+    return {'ns': index.asi8.astype(float)}
+
+def test_grid_arrays_frame_larger_than_memo(monkeypatch):
+    # three hours of 1 s samples, while the memo only holds one hour block
+    monkeypatch.setattr(snc, 'array_memo', {})
+    monkeypatch.setattr(snc, 'array_memo_used', 0)
+    monkeypatch.setattr(snc, 'array_memo_size', 3600 * 8 + 1)
+    index = pd.date_range('2010-01-01 00:00', periods=3 * 3600, freq='1s', \
+            tz='Pacific/Honolulu')
+    out = snc.grid_arrays(None, ['test'], index, timestamps)
+    np.testing.assert_array_equal(out['ns'], index.asi8.astype(float))
+    assert len(snc.array_memo) == 1
+
+    # the second call takes the last hour from the memo
+    out = snc.grid_arrays(None, ['test'], index[1:], timestamps)
+    np.testing.assert_array_equal(out['ns'], index[1:].asi8.astype(float))